@@ -0,0 +1,289 @@
+"""Offline benchmark for the command handlers.
+
+Pre-populates a throwaway data directory with synthetic players, tables and
+promoters, then drives every command handler through the real Application
+with synthetic Updates and a stubbed Bot API (no network):
+
+    python bench.py --sizes 1000,10000,100000 --backend json --out bench_report.json
+
+Reports per-handler latency percentiles, allocation peaks and bytes written
+to disk, as a table on stdout and as JSON in --out.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from itertools import count
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import main
+from offline import StubRequest, callback_update, command_update, offline_application
+from lobby import Lobby
+from outbox import Outbox
+from serialization import get_serializer
+from storage import SqliteStore, StateStore, Storage
+
+ADMIN = 1
+GROUP_CHAT = -100
+PLAYER_BASE = 1_000_000  # pre-populated players
+NEW_USER_BASE = 9_000_000  # users first seen during the run
+TABLE_SIZE = main.DEFAULT_POOL.size
+
+
+def open_store(backend: str, data_dir: Path) -> Storage:
+    if backend == "sqlite":
+        store: Storage = SqliteStore(data_dir / "state.db")
+    else:
+        store = StateStore(
+            data_dir / "state.snapshot",
+            data_dir / "state.wal",
+            data_dir / "tables.archive.jsonl",
+            get_serializer(main.SNAPSHOT_CODEC),
+            data_dir / "ledger.jsonl",
+        )
+    store.open()
+    return store
+
+
+def dir_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+
+
+async def populate(
+    store: Storage, players: int, tables: int, promoters: int, running: int
+) -> List[Dict[str, Any]]:
+    """Fill the store; returns ``running`` open tables for /winner."""
+    store.flush_max_pending = 1 << 62  # one flush at the end
+    uids = [PLAYER_BASE + i for i in range(max(players, TABLE_SIZE))]
+    for uid in uids:
+        store.create_player(uid, f"player{uid}", f"Player{uid}")
+    for uid in uids[:promoters]:
+        store.create_promoter(uid, f"player{uid}", f"Player{uid}")
+    if promoters:
+        for i, uid in enumerate(uids[::3]):
+            promoter_id = uids[i % promoters]
+            if promoter_id != uid:
+                store.refer_player(uid, promoter_id)
+
+    seats = (uid for _ in count() for uid in uids)
+    open_tables = []
+    for n in range(tables + running):
+        table = main.create_table(store, main.DEFAULT_POOL)
+        seated = [next(seats) for _ in range(TABLE_SIZE)]
+        for uid in seated:
+            store.join_table(table.id, uid)
+        store.start_table(table.id)
+        if n < tables:
+            store.finish_table(table.id, seated[0])
+        else:
+            open_tables.append({"id": table.id, "winner": seated[0]})
+    store.snapshot()
+    store.drain()
+    store.flush_max_pending = main.FLUSH_MAX_PENDING
+    return open_tables
+
+
+def scenarios(app, open_tables: List[Dict[str, Any]]) -> Dict[str, Callable[[int], Any]]:
+    new_users = count(NEW_USER_BASE)
+    running = iter(open_tables)
+
+    def start(i):
+        promoter = PLAYER_BASE + i % 10
+        return command_update(app, next(new_users), f"/start promo_{promoter}")
+
+    def winner(i):
+        table = next(running)
+        return command_update(app, ADMIN, f"/winner {table['id']} {table['winner']}")
+
+    tapper = None
+    # the button's table only picks the pool and keys the dedupe here, a tap
+    # seats at whichever table of the pool is waiting
+    lobby_table = main.create_table(main.store, main.DEFAULT_POOL).id
+    pool_names = list(main.POOLS)
+
+    def join_tap(i):
+        # every user taps Join twice
+        nonlocal tapper
+        if i % 2 == 0:
+            tapper = next(new_users)
+        return callback_update(app, tapper, f"join:{lobby_table}", GROUP_CHAT)
+
+    def join_pools(i):
+        pool = pool_names[i % len(pool_names)]
+        return command_update(
+            app, next(new_users), f"/join {pool}", chat_type="group", chat_id=GROUP_CHAT
+        )
+
+    return {
+        "start": start,
+        "status": lambda i: command_update(app, PLAYER_BASE + i, "/status"),
+        "promo": lambda i: command_update(app, PLAYER_BASE + i, "/promo"),
+        "join": lambda i: command_update(
+            app, next(new_users), "/join", chat_type="group", chat_id=GROUP_CHAT
+        ),
+        "join_tap": join_tap,
+        "join_pools": join_pools,
+        "winner": winner,
+        "tables": lambda i: command_update(app, ADMIN, "/tables"),
+        "promostats": lambda i: command_update(app, ADMIN, "/promostats"),
+        "summary": lambda i: command_update(app, ADMIN, "/summary"),
+    }
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def bench_size(args, size: int) -> List[Dict[str, Any]]:
+    players = size
+    tables = int(size * args.table_ratio)
+    promoters = int(size * args.promoter_ratio)
+    calls_per_handler = args.iterations + args.alloc_iterations
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = Path(tmp)
+        store = open_store(args.backend, data_dir)
+        store.flush_interval = args.flush_ms / 1000
+        t0 = time.perf_counter()
+        open_tables = await populate(store, players, tables, promoters, calls_per_handler)
+        populate_s = time.perf_counter() - t0
+
+        request = StubRequest()
+        app = offline_application(request)
+        main.add_handlers(app)
+        await app.initialize()
+        main.store = store
+        main.bot_username = app.bot.username
+        main.ADMIN_ID = ADMIN
+        # replies are sent by the outbox after the handler returns; unpaced,
+        # since the stub API has no flood limits
+        main.outbox = Outbox(global_rate=0, chat_rate=0, group_rate=0)
+        await main.outbox.start(app.bot)
+        main.lobby = Lobby(main.outbox, main.LOBBY_DEBOUNCE_MS / 1000)
+
+        results = []
+        for name, make_update in scenarios(app, open_tables).items():
+            if args.handlers and name not in args.handlers:
+                continue
+            updates = [make_update(i) for i in range(calls_per_handler)]
+            timed, traced = updates[: args.iterations], updates[args.iterations:]
+
+            store.drain()
+            api_calls = len(request.calls)
+            before = dir_bytes(data_dir)
+            latencies = []
+            for update in timed:
+                t0 = time.perf_counter()
+                await app.process_update(update)
+                latencies.append((time.perf_counter() - t0) * 1000)
+            await main.lobby.drain()
+            await main.outbox.drain()
+            store.drain()
+            written = dir_bytes(data_dir) - before
+            api_calls = len(request.calls) - api_calls
+
+            peaks = []
+            tracemalloc.start()
+            for update in traced:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                await app.process_update(update)
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+            tracemalloc.stop()
+            await main.lobby.drain()
+            await main.outbox.drain()
+
+            latencies.sort()
+            results.append({
+                "size": size,
+                "players": players,
+                "tables": tables,
+                "promoters": promoters,
+                "backend": args.backend,
+                "handler": name,
+                "iterations": len(latencies),
+                "p50_ms": percentile(latencies, 50),
+                "p90_ms": percentile(latencies, 90),
+                "p99_ms": percentile(latencies, 99),
+                "max_ms": latencies[-1],
+                "mean_ms": statistics.fmean(latencies),
+                "alloc_peak_bytes": int(statistics.fmean(peaks)) if peaks else None,
+                "bytes_written": max(written, 0),
+                "api_calls_per_update": api_calls / len(latencies),
+                "populate_s": populate_s,
+            })
+
+        await main.outbox.stop(5)
+        await app.shutdown()
+        store.close()
+    return results
+
+
+def print_table(results: List[Dict[str, Any]]) -> None:
+    header = (
+        f"{'size':>8} {'handler':<11} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+        f"{'alloc KiB':>10} {'written B':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        alloc = "-" if r["alloc_peak_bytes"] is None else f"{r['alloc_peak_bytes'] / 1024:.1f}"
+        print(
+            f"{r['size']:>8} {r['handler']:<11} {r['p50_ms']:>9.3f} {r['p90_ms']:>9.3f} "
+            f"{r['p99_ms']:>9.3f} {alloc:>10} {r['bytes_written']:>10}"
+        )
+
+
+async def run(args) -> Dict[str, Any]:
+    results = []
+    for size in args.sizes:
+        results.extend(await bench_size(args, size))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "iterations": args.iterations,
+            "flush_ms": args.flush_ms,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: [int(x) for x in s.split(",")],
+        default=[1000, 10000],
+        help="comma-separated player counts (default: 1000,10000)",
+    )
+    parser.add_argument("--table-ratio", type=float, default=1.0,
+                        help="finished tables per player (default: 1.0)")
+    parser.add_argument("--promoter-ratio", type=float, default=0.1,
+                        help="promoters per player (default: 0.1)")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--alloc-iterations", type=int, default=20,
+                        help="extra calls per handler measured with tracemalloc")
+    parser.add_argument("--flush-ms", type=float, default=main.FLUSH_INTERVAL_MS,
+                        help="group commit window (default: FLUSH_INTERVAL_MS)")
+    parser.add_argument("--handlers", type=lambda s: s.split(","), default=None,
+                        help="only run these handlers")
+    parser.add_argument("--out", type=Path, default=Path("bench_report.json"))
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(run(args))
+    print_table(report["results"])
+    args.out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"\nReport written to {args.out}")
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+# Just enough HTTP/1.1 for the Telegram webhook, health checks and a metrics
+# page: one request per connection, Content-Length bodies only.
+
+Response = Tuple[int, str, bytes]  # status, content type, body
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class Request:
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers  # lower-cased names
+        self.body = body
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+def text_response(status: int, text: str) -> Response:
+    return status, "text/plain; charset=utf-8", text.encode("utf-8")
+
+
+class HttpServer:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        max_body: int = 1 << 20,
+        read_timeout: float = 10.0,
+    ):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        self._routes: Dict[Tuple[str, str], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: Handler) -> None:
+        self._routes[(method.upper(), path)] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        if self.port == 0:
+            # ephemeral port, mostly for local testing
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            try:
+                request = await asyncio.wait_for(
+                    self._read_request(reader), self.read_timeout
+                )
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                request = None
+            if request is None:
+                response = text_response(400, "bad request")
+            elif isinstance(request, int):
+                response = text_response(request, REASONS[request].lower())
+            else:
+                response = await self._dispatch(request)
+            await self._write_response(writer, response)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        method, target, _version = request_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        if length > self.max_body:
+            return 413
+        body = await reader.readexactly(length) if length else b""
+        path = target.split("?", 1)[0]
+        return Request(method.upper(), path, headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return text_response(405, "method not allowed")
+            return text_response(404, "not found")
+        try:
+            return await handler(request)
+        except Exception:
+            logger.exception("%s %s failed", request.method, request.path)
+            return text_response(500, "internal error")
+
+    async def _write_response(
+        self, writer: asyncio.StreamWriter, response: Response
+    ) -> None:
+        status, content_type, body = response
+        head = (
+            f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
@@ -0,0 +1,53 @@
+from typing import Dict, Iterable, List
+
+from models import LedgerEntry
+
+# ---------- LEDGER ----------
+# Every movement of money is one append-only entry taking ``amount`` from its
+# credit account and giving it to its debit account, so all balances always
+# sum to zero. A table's pot receives the buy-ins and pays out the prize and
+# the house cut, or refunds the buy-ins if it expires; the house pays
+# promoter bonuses; a settlement pays each promoter's balance out to the
+# payouts account. Entries are never changed: a payout settles every earlier
+# entry on that promoter's account.
+#
+# Balances are not stored anywhere; they are a fold over the entries, which
+# the stores stream in id order (Storage.iter_ledger).
+
+HOUSE = "house"
+PAYOUTS = "payouts"  # money that has left the books
+
+
+def player_account(uid: int) -> str:
+    return f"player:{uid}"
+
+
+def promoter_account(uid: int) -> str:
+    return f"promoter:{uid}"
+
+
+def table_account(table_id: int) -> str:
+    return f"table:{table_id}"
+
+
+def balances(entries: Iterable[LedgerEntry]) -> Dict[str, float]:
+    """Account -> debits minus credits, in one pass."""
+    totals: Dict[str, float] = {}
+    for entry in entries:
+        totals[entry.debit] = totals.get(entry.debit, 0) + entry.amount
+        totals[entry.credit] = totals.get(entry.credit, 0) - entry.amount
+    return totals
+
+
+def unsettled(entries: Iterable[LedgerEntry]) -> Dict[str, List[LedgerEntry]]:
+    """Promoter account -> its entries no payout has settled yet.
+
+    Memory grows with the unsettled entries only, not with the ledger.
+    """
+    open_entries: Dict[str, List[LedgerEntry]] = {}
+    for entry in entries:
+        if entry.kind == "payout":
+            open_entries.pop(entry.credit, None)
+        elif entry.debit.startswith("promoter:"):
+            open_entries.setdefault(entry.debit, []).append(entry)
+    return open_entries
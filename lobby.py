@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from telegram import InlineKeyboardMarkup, Message
+
+from outbox import NORMAL, Outbox
+
+# ---------- LOBBY ----------
+# One message per waiting table, posted when its first player joins and then
+# edited in place as the table fills, instead of a new message per join.
+# Edits are debounced: joins within ``debounce`` seconds of each other end up
+# in a single edit showing the latest seating. Callback queries from the Join
+# button are answered together with the edit that shows the tapper seated.
+
+View = Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]
+Answer = Callable[[], Awaitable[Any]]  # e.g. a bound CallbackQuery.answer
+
+logger = logging.getLogger(__name__)
+
+
+class _LobbyMessage:
+    __slots__ = ("chat_id", "render", "text", "posted", "pending", "answers")
+
+    def __init__(self, chat_id: int, render: Callable[[], View], text: str):
+        self.chat_id = chat_id
+        self.render = render  # current text and keyboard, None once it filled up
+        self.text = text  # as last sent
+        self.posted: Optional[asyncio.Task] = None  # -> Message, or None if dropped
+        self.pending: Optional[asyncio.Task] = None  # debounced edit
+        self.answers: List[Answer] = []  # due once the next post or edit is out
+
+
+class Lobby:
+    def __init__(self, outbox: Outbox, debounce: float = 1.0):
+        self.outbox = outbox
+        self.debounce = debounce
+        self._open: Dict[int, _LobbyMessage] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def update(
+        self,
+        table_id: int,
+        chat_id: int,
+        render: Callable[[], View],
+        answer: Optional[Answer] = None,
+    ) -> int:
+        """Show the table's current seating; returns the lobby's chat id.
+
+        The first call posts the lobby message in ``chat_id``; later ones
+        schedule an edit of it, wherever it is, rendered when the edit is
+        sent. ``answer`` is called once that post or edit has gone out.
+        """
+        entry = self._open.get(table_id)
+        if entry is None:
+            view = render()
+            if view is None:
+                self._answer_now(answer)
+                return chat_id
+            text, markup = view
+            entry = self._open[table_id] = _LobbyMessage(chat_id, render, text)
+            entry.posted = self._spawn(self._post(entry, markup))
+        elif entry.pending is None:
+            entry.pending = self._spawn(self._edit_later(table_id, entry))
+        if answer is not None:
+            entry.answers.append(answer)
+        return entry.chat_id
+
+    def close(
+        self,
+        table_id: int,
+        text: str,
+        answer: Optional[Answer] = None,
+        announcement: Optional[str] = None,
+    ) -> Optional[int]:
+        """Replace the lobby message with ``text`` and drop its keyboard.
+
+        ``announcement`` follows as a new message replying to it, since edits
+        notify nobody. Without one, ``text`` itself is sent as a new message
+        if the lobby message can't be edited. Returns the lobby's chat id, or
+        None if the table has no lobby message.
+        """
+        entry = self._open.pop(table_id, None)
+        if entry is None:
+            self._answer_now(answer)
+            return None
+        if entry.pending is not None:
+            entry.pending.cancel()
+            entry.pending = None
+        if answer is not None:
+            entry.answers.append(answer)
+        self._spawn(self._close(entry, text, announcement))
+        return entry.chat_id
+
+    async def drain(self) -> None:
+        """Send pending edits now and wait for every lobby message to go out."""
+        for entry in list(self._open.values()):
+            if entry.pending is not None:
+                entry.pending.cancel()
+                entry.pending = None
+                self._spawn(self._refresh(entry))
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _post(
+        self, entry: _LobbyMessage, markup: Optional[InlineKeyboardMarkup]
+    ) -> Optional[Message]:
+        try:
+            sent = await self.outbox.send(
+                entry.chat_id, entry.text, NORMAL, reply_markup=markup
+            )
+            return None if sent is None else await sent
+        finally:
+            await self._answer(entry)
+
+    async def _edit_later(self, table_id: int, entry: _LobbyMessage) -> None:
+        await asyncio.sleep(self.debounce)
+        entry.pending = None
+        if self._open.get(table_id) is entry:
+            await self._refresh(entry)
+
+    async def _refresh(self, entry: _LobbyMessage) -> None:
+        view = entry.render()
+        if view is None:
+            # a table that just filled up is about to be closed instead
+            await self._answer(entry)
+        else:
+            await self._edit(entry, *view)
+
+    async def _close(
+        self, entry: _LobbyMessage, text: str, announcement: Optional[str]
+    ) -> None:
+        edited = self._spawn(self._edit(entry, text, None))
+        message = await entry.posted
+        if announcement is not None:
+            kwargs: Dict[str, Any] = {}
+            if message is not None:
+                kwargs["reply_to_message_id"] = message.message_id
+                # still deliver if the lobby message was deleted meanwhile
+                kwargs["allow_sending_without_reply"] = True
+            await self.outbox.send(entry.chat_id, announcement, NORMAL, **kwargs)
+        elif not await edited:
+            await self.outbox.send(entry.chat_id, text, NORMAL)
+
+    async def _edit(
+        self, entry: _LobbyMessage, text: str, markup: Optional[InlineKeyboardMarkup]
+    ) -> bool:
+        """False if the lobby message could not be edited."""
+        try:
+            message = await entry.posted
+            if message is None:
+                logger.warning("lobby message in %s was never posted", entry.chat_id)
+                return False
+            if text == entry.text and markup is not None:
+                # Telegram rejects edits that change nothing
+                return True
+            entry.text = text
+            edited = await self.outbox.edit(
+                entry.chat_id, message.message_id, text, NORMAL, reply_markup=markup
+            )
+            return edited is not None and await edited is not None
+        finally:
+            await self._answer(entry)
+
+    async def _answer(self, entry: _LobbyMessage) -> None:
+        answers, entry.answers = entry.answers, []
+        await self._answer_all(answers)
+
+    def _answer_now(self, answer: Optional[Answer]) -> None:
+        if answer is not None:
+            self._spawn(self._answer_all([answer]))
+
+    @staticmethod
+    async def _answer_all(answers: List[Answer]) -> None:
+        results = await asyncio.gather(*(a() for a in answers), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("answering a callback query failed: %s", result)
+
+
+class TapGuard:
+    """Recent button taps, so repeats are answered without redoing the work.
+
+    Telegram sends a new callback query for every tap and may deliver the
+    same query twice. A query id seen before is ignored; another tap on the
+    same ``key`` (e.g. user and table) within ``window`` seconds shares the
+    first tap's outcome.
+    """
+
+    def __init__(self, window: float = 30.0):
+        self.window = window
+        self.repeats = 0
+        # both in insertion order, which is expiry order for a fixed window
+        self._ids: "OrderedDict[str, float]" = OrderedDict()
+        self._taps: "OrderedDict[Any, Tuple[float, asyncio.Future]]" = OrderedDict()
+
+    def seen(self, query_id: str) -> bool:
+        now = time.monotonic()
+        while self._ids and next(iter(self._ids.values())) <= now:
+            self._ids.popitem(last=False)
+        if query_id in self._ids:
+            return True
+        self._ids[query_id] = now + self.window
+        return False
+
+    def earlier(self, key: Any) -> Optional[asyncio.Future]:
+        """Future outcome of a recent tap on ``key``.
+
+        None if there was none; this tap is then the one to settle() it.
+        """
+        now = time.monotonic()
+        while self._taps and next(iter(self._taps.values()))[0] <= now:
+            self._taps.popitem(last=False)
+        tap = self._taps.get(key)
+        if tap is not None:
+            self.repeats += 1
+            return tap[1]
+        future = asyncio.get_running_loop().create_future()
+        self._taps[key] = (now + self.window, future)
+        return None
+
+    def settle(self, key: Any, outcome: Any) -> None:
+        tap = self._taps.get(key)
+        if tap is not None and not tap[1].done():
+            tap[1].set_result(outcome)
+
+    def forget(self, key: Any) -> None:
+        """Drop a tap that failed, so the next one tries again."""
+        tap = self._taps.pop(key, None)
+        if tap is not None and not tap[1].done():
+            tap[1].set_result(None)
@@ -1,7 +1,16 @@
+import asyncio
+import hmac
 import json
+import logging
+import logging.handlers
 import os
+import signal
+import time
+import weakref
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from telegram import (
@@ -14,179 +23,375 @@ from telegram.ext import (
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
+    TypeHandler,
+)
+
+from httpserver import HttpServer, Request, Response, text_response
+from metrics import (
+    TimedRequest,
+    instrument_application,
+    instrument_storage,
+    render_prometheus,
+)
+from lobby import Answer, Lobby, TapGuard
+from models import Player, Promoter, Table
+from outbox import HIGH, LOW, Outbox
+from serialization import get_serializer
+from timers import TimerHeap
+from paging import Page, Pager
+from pools import Pool, parse_pools
+from storage import (
+    PROMOTER_ORDERS,
+    SqliteStore,
+    StateStore,
+    Storage,
+    iso_week,
+    promoter_key,
 )
 
 # ---------- CONFIG ----------
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / "data"
-STATE_FILE = DATA_DIR / "state.json"
+STATE_FILE = DATA_DIR / "state.snapshot"
+LEGACY_STATE_FILE = DATA_DIR / "state.json"  # JSON-only snapshots of older versions
+WAL_FILE = DATA_DIR / "state.wal"
+ARCHIVE_FILE = DATA_DIR / "tables.archive.jsonl"
+LEDGER_FILE = DATA_DIR / "ledger.jsonl"
+DB_FILE = DATA_DIR / "state.db"
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # set this in Render
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))  # your Telegram user ID
 GROUP_ID = int(os.getenv("GROUP_ID", "0"))  # main public group chat id (optional)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # json | sqlite
+FLUSH_INTERVAL_MS = int(os.getenv("FLUSH_INTERVAL_MS", "100"))  # group commit window
+FLUSH_MAX_PENDING = int(os.getenv("FLUSH_MAX_PENDING", "64"))  # ...or flush after N writes
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", "300"))  # seconds
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC", "binary")  # json | msgpack | pickle | binary
+ARCHIVE_AFTER = int(os.getenv("ARCHIVE_AFTER", "86400"))  # seconds a finished table stays live
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base url; unset = don't call setWebhook
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))  # Render provides PORT
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# required in webhook mode: admin checks trust the sender named in an update
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # checked against Telegram's secret header
+
+RECORD_UPDATES = os.getenv("RECORD_UPDATES")  # path of a JSONL update recording (opt-in)
+RECORD_MAX_BYTES = int(os.getenv("RECORD_MAX_BYTES", str(50 * 1024 * 1024)))
+RECORD_BACKUPS = int(os.getenv("RECORD_BACKUPS", "5"))
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = no /metrics endpoint
+
+# outgoing message pacing, messages per second; Telegram's flood limits
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # private chats
+OUTBOX_GROUP_RATE = float(os.getenv("OUTBOX_GROUP_RATE", str(20 / 60)))
+OUTBOX_BURST = float(os.getenv("OUTBOX_BURST", "3"))  # per chat
+OUTBOX_MAX_QUEUED = int(os.getenv("OUTBOX_MAX_QUEUED", "10000"))
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "10"))  # on shutdown
+LOBBY_DEBOUNCE_MS = int(os.getenv("LOBBY_DEBOUNCE_MS", "1500"))  # joins folded into one edit
+JOIN_TAP_WINDOW = float(os.getenv("JOIN_TAP_WINDOW", "30"))  # seconds a Join tap is remembered
+
+# stale tables; 0 turns a timeout off
+WAITING_TABLE_TIMEOUT = int(os.getenv("WAITING_TABLE_TIMEOUT", "1800"))  # s without a join
+RUNNING_TABLE_TIMEOUT = int(os.getenv("RUNNING_TABLE_TIMEOUT", "3600"))  # s without /winner
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", "30"))  # seconds between timeout checks
 
 CASH_TAG = "$MichaelThornton40"  # your payout / buy-in tag
-TABLE_SIZE = 5
-BUY_IN = 5
-WIN_PRIZE = 20
-HOUSE_CUT = 5
+# name:seats:buy_in:prize:house_cut, comma-separated; the first is plain /join's
+TABLE_POOLS = os.getenv("TABLE_POOLS", "5:5:5:20:5,10:5:10:40:10,20:5:20:80:20")
+POOLS = parse_pools(TABLE_POOLS)
+DEFAULT_POOL = next(iter(POOLS.values()))
 PROMO_BONUS = 2.0  # $2 per active referred player
+PAGE_SIZE = 20  # lines per /tables and /promostats page
 
 
 # ---------- STATE MANAGEMENT ----------
 
-def load_state() -> Dict[str, Any]:
-    DATA_DIR.mkdir(exist_ok=True)
-    if not STATE_FILE.exists():
-        return {
-            "tables": {},        # table_id -> table data
-            "next_table_id": 1,
-            "players": {},       # user_id -> player info
-            "promoters": {},     # user_id -> promoter info
-        }
-    try:
-        with STATE_FILE.open("r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {
-            "tables": {},
-            "next_table_id": 1,
-            "players": {},
-            "promoters": {},
-        }
-
-
-def save_state(state: Dict[str, Any]) -> None:
-    DATA_DIR.mkdir(exist_ok=True)
-    with STATE_FILE.open("w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2)
-
-
-def get_or_create_player(state: Dict[str, Any], user) -> Dict[str, Any]:
-    uid = str(user.id)
-    players = state.setdefault("players", {})
-    if uid not in players:
-        players[uid] = {
-            "id": user.id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "joined_tables": 0,
-            "wins": 0,
-            "referred_by": None,
-            "promo_code": None,
-        }
-    return players[uid]
-
-
-def get_or_create_promoter(state: Dict[str, Any], user) -> Dict[str, Any]:
-    uid = str(user.id)
-    promoters = state.setdefault("promoters", {})
-    if uid not in promoters:
-        promoters[uid] = {
-            "id": user.id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "promo_code": f"promo_{user.id}",
-            "referred_players": 0,
-            "pending_payout": 0.0,
-            "total_paid": 0.0,
-        }
-    return promoters[uid]
-
-
-def find_waiting_table(state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    for table in state["tables"].values():
-        if table["status"] == "waiting" and len(table["players"]) < TABLE_SIZE:
-            return table
-    return None
+def make_store() -> Storage:
+    if STORAGE_BACKEND == "sqlite":
+        store = SqliteStore(DB_FILE)
+    elif STORAGE_BACKEND == "json":
+        store = StateStore(
+            STATE_FILE,
+            WAL_FILE,
+            ARCHIVE_FILE,
+            get_serializer(SNAPSHOT_CODEC),
+            LEDGER_FILE,
+        )
+    else:
+        raise RuntimeError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    store.flush_interval = FLUSH_INTERVAL_MS / 1000
+    store.flush_max_pending = FLUSH_MAX_PENDING
+    return store
+
+
+store = make_store()
+# time spent in any repository call counts as storage time in /metrics
+instrument_storage(
+    store,
+    [
+        name
+        for name, value in vars(Storage).items()
+        if callable(value) and not name.startswith("_")
+    ],
+)
 
+outbox = Outbox(
+    global_rate=OUTBOX_GLOBAL_RATE,
+    chat_rate=OUTBOX_CHAT_RATE,
+    group_rate=OUTBOX_GROUP_RATE,
+    burst=OUTBOX_BURST,
+    max_queued=OUTBOX_MAX_QUEUED,
+)
+lobby = Lobby(outbox, LOBBY_DEBOUNCE_MS / 1000)
+join_taps = TapGuard(JOIN_TAP_WINDOW)
+pager = Pager(PAGE_SIZE)
+table_timers = TimerHeap()  # live table id -> when it goes stale
+
+bot_username: Optional[str] = None  # resolved once in post_init
+referral_links: Dict[int, str] = {}  # promoter user_id -> t.me deep link
+
+
+def get_or_create_player(store: Storage, user) -> Player:
+    uid = user.id
+    player = store.player(uid)
+    if player is None:
+        player = store.create_player(uid, user.username, user.first_name)
+    elif (player.username, player.first_name) != (
+        user.username,
+        user.first_name,
+    ):
+        # keep the username index current when someone renames
+        player = store.rename_player(uid, user.username, user.first_name)
+    return player
+
+
+def get_or_create_promoter(store: Storage, user) -> Promoter:
+    uid = user.id
+    promoter = store.promoter(uid)
+    if promoter is None:
+        promoter = store.create_promoter(uid, user.username, user.first_name)
+    if uid not in referral_links:
+        referral_links[uid] = (
+            f"https://t.me/{bot_username}?start={promoter.promo_code}"
+        )
+    return promoter
 
-def create_table(state: Dict[str, Any]) -> Dict[str, Any]:
-    table_id = state["next_table_id"]
-    state["next_table_id"] += 1
-    table = {
-        "id": table_id,
-        "status": "waiting",  # waiting | running | finished
-        "buy_in": BUY_IN,
-        "players": [],
-        "winner_id": None,
-        "promoters": {},  # promoter_user_id -> count of referred players in this table
-    }
-    state["tables"][str(table_id)] = table
+
+def find_waiting_table(store: Storage, pool: Pool) -> Optional[Table]:
+    table = store.waiting_table(pool.name, pool.size)
+    if table is None and pool is DEFAULT_POOL:
+        # tables from before pools existed belong to the default pool
+        table = store.waiting_table(None, pool.size)
     return table
 
 
+def create_table(store: Storage, pool: Pool) -> Table:
+    return store.create_table(
+        pool.buy_in, pool.prize, pool.house_cut, pool.name, pool.size
+    )
+
+
+def table_terms(table: Table) -> Pool:
+    """The pool terms ``table`` was created with."""
+    if table.size is None:
+        # from before pools existed: the default pool's seats, its own split
+        return Pool(
+            DEFAULT_POOL.name,
+            DEFAULT_POOL.size,
+            table.buy_in,
+            table.prize,
+            table.house_cut,
+        )
+    return Pool(table.pool, table.size, table.buy_in, table.prize, table.house_cut)
+
+
+def pool_choices() -> str:
+    return ", ".join(
+        f"{p.name} (${p.buy_in}, {p.size} players)" for p in POOLS.values()
+    )
+
+
+# ---------- CONCURRENCY ----------
+# Updates are processed concurrently. Anything that reads state, awaits and
+# then writes based on what it read must hold the matching lock across that
+# window: the registry lock for players, promoters and matchmaking, a table
+# lock for everything that touches one table. Lock order is registry, then
+# table. Never hold a lock across store.commit() or a Telegram call unless
+# the handler's correctness depends on it.
+
+registry_lock = asyncio.Lock()
+_table_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+def table_lock(table_id: int) -> asyncio.Lock:
+    # kept only while someone holds or waits on it, so finished tables
+    # don't leave locks behind
+    lock = _table_locks.get(table_id)
+    if lock is None:
+        lock = _table_locks[table_id] = asyncio.Lock()
+    return lock
+
+
+def resolve_winner(args, replied) -> Optional[int]:
+    """User id named by /winner's arguments or the message it replies to."""
+    if args:
+        target = args[0]
+        if target.isdigit():
+            return int(target)
+        return store.player_by_username(target.lstrip("@"))
+    if replied is not None and replied.from_user is not None:
+        return replied.from_user.id
+    return None
+
+
+# ---------- TABLE TIMEOUTS ----------
+# Each live table has one deadline in table_timers, moved on every join and
+# when it starts, dropped when it finishes. A waiting table that reaches its
+# deadline expires and its buy-ins are refunded; a running one gets the
+# admin a reminder to report the winner, repeated every timeout. Deadlines
+# are not persisted: after a restart every live table starts a full timeout.
+
+TABLE_TIMEOUTS = {"waiting": WAITING_TABLE_TIMEOUT, "running": RUNNING_TABLE_TIMEOUT}
+
+
+def schedule_timeout(table_id: int, status: str) -> None:
+    timeout = TABLE_TIMEOUTS.get(status, 0)
+    if timeout:
+        table_timers.schedule(table_id, time.monotonic() + timeout)
+    else:
+        table_timers.cancel(table_id)
+
+
+def schedule_live_tables() -> None:
+    for table in store.iter_tables():
+        schedule_timeout(table.id, table.status)
+
+
+async def sweep_table(table_id: int) -> None:
+    # the registry lock keeps matchmaking from seating anyone meanwhile
+    async with registry_lock, table_lock(table_id):
+        if table_id in table_timers:
+            return  # a join moved the deadline while we waited for the locks
+        table = store.table(table_id)
+        if table is None or table.status not in TABLE_TIMEOUTS:
+            return
+        if table.status == "running":
+            schedule_timeout(table_id, "running")
+            expired = None
+        else:
+            expired = store.cancel_table(table_id)
+            # records may be live views; take what we need now
+            players, buy_in = list(expired.players), expired.buy_in
+            size = table_terms(expired).size
+
+    if expired is None:
+        if ADMIN_ID:
+            await outbox.send(
+                ADMIN_ID,
+                f"⏰ Table #{table_id} is still running without a winner.\n"
+                f"Report it with /winner {table_id} @username.",
+                HIGH,
+            )
+        return
+
+    await store.commit()
+    text = (
+        f"⌛ Table #{table_id} expired with {len(players)}/{size} players.\n"
+        "Buy-ins will be refunded. Send /join to start a new table."
+    )
+    if lobby.close(table_id, text) is None and GROUP_ID:
+        await outbox.send(GROUP_ID, text)
+    if ADMIN_ID and players:
+        names = []
+        for pid in players:
+            p = store.player(pid)
+            names.append(f"@{p.username}" if p and p.username else str(pid))
+        await outbox.send(
+            ADMIN_ID,
+            f"⌛ Table #{table_id} expired. Refund ${buy_in} each to: {', '.join(names)}",
+            HIGH,
+        )
+
+
 # ---------- COMMAND HANDLERS ----------
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = load_state()
     user = update.effective_user
     args = context.args
 
-    player = get_or_create_player(state, user)
-
-    # Handle referral: /start promo_12345
-    if args and args[0].startswith("promo_") and player["referred_by"] is None:
-        promoter_id = args[0].split("_", 1)[1]
-        if promoter_id != str(user.id):  # no self-ref
-            player["referred_by"] = promoter_id
-            # register promoter
-            promoters = state.setdefault("promoters", {})
-            if promoter_id not in promoters:
-                promoters[promoter_id] = {
-                    "id": int(promoter_id),
-                    "username": None,
-                    "first_name": None,
-                    "promo_code": f"promo_{promoter_id}",
-                    "referred_players": 0,
-                    "pending_payout": 0.0,
-                    "total_paid": 0.0,
-                }
-            promoters[promoter_id]["referred_players"] += 1
-
-    save_state(state)
+    async with registry_lock:
+        with store.batch():
+            player = get_or_create_player(store, user)
+
+            # Handle referral: /start promo_12345
+            if args and args[0].startswith("promo_") and player.referred_by is None:
+                code = args[0].split("_", 1)[1]
+                if code.isdigit() and int(code) != user.id:  # no self-ref
+                    promoter_id = int(code)
+                    # register promoter
+                    if store.promoter(promoter_id) is None:
+                        store.create_promoter(promoter_id, None, None)
+                    store.refer_player(user.id, promoter_id)
 
     text = (
-        "🎱 Welcome to the $5 Pool Tournament!\n\n"
-        "• 5 players per table\n"
-        f"• Buy-in: ${BUY_IN} (send to {CASH_TAG})\n"
-        f"• Winner gets: ${WIN_PRIZE}\n"
-        f"• House keeps: ${HOUSE_CUT}\n"
+        "🎱 Welcome to the Pool Tournament!\n\n"
+        + "".join(
+            f"• ${p.buy_in} tables: {p.size} players, winner gets ${p.prize}, "
+            f"house keeps ${p.house_cut} (/join {p.name})\n"
+            for p in POOLS.values()
+        )
+        + f"• Send buy-ins to {CASH_TAG}\n"
         "• Promoters earn $2 per active player they bring in\n\n"
-        "Use /join in the public group to join the next table.\n"
+        f"Use /join in the public group to join the next ${DEFAULT_POOL.buy_in} "
+        "table, or /join <table> for another one.\n"
         "Use /promo here to get your personal referral link."
     )
-    await update.message.reply_text(text)
+    await outbox.reply(update.message, text, LOW)
 
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
         "🎱 Commands:\n"
-        "/join – join the next $5 table (in the group)\n"
+        f"/join [{'|'.join(POOLS)}] – join the next table of that pool "
+        f"(default {DEFAULT_POOL.name}; in the group)\n"
         "/promo – get your referral link\n"
         "/status – see your stats\n\n"
         "Admin only:\n"
-        "/tables – list tables\n"
-        "/winner <table_id> @user – mark winner and close table\n"
-        "/promostats – show promoter balances\n"
+        "/tables [waiting|running|finished|cancelled] – list live tables\n"
+        "/tables archive [page] – list finished, archived tables\n"
+        "/winner <table_id> @user|user_id – mark winner and close table\n"
+        "  (or reply to the winner's message with /winner <table_id>)\n"
+        "/promostats [balance] – show promoter balances\n"
+        "/summary – totals across all tables and promoters\n"
+        "/settle – pay out every pending promoter balance\n"
     )
-    await update.message.reply_text(text)
+    await outbox.reply(update.message, text, LOW)
 
 
 async def promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = load_state()
     user = update.effective_user
-    promoter = get_or_create_promoter(state, user)
-    # sync username/name
-    promoter["username"] = user.username
-    promoter["first_name"] = user.first_name
-    save_state(state)
-
-    bot_username = (await context.bot.get_me()).username
-    link = f"https://t.me/{bot_username}?start={promoter['promo_code']}"
+    async with registry_lock:
+        with store.batch():
+            promoter = get_or_create_promoter(store, user)
+            # sync username/name
+            if (promoter.username, promoter.first_name) != (
+                user.username,
+                user.first_name,
+            ):
+                promoter = store.rename_promoter(
+                    user.id, user.username, user.first_name
+                )
+
+    link = referral_links[user.id]
 
     text = (
         "💸 Your promoter details:\n\n"
@@ -194,205 +399,529 @@ async def promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Pay-in cash tag: {CASH_TAG}\n"
         "You earn $2 for each referred player who plays a table."
     )
-    await update.message.reply_text(text)
+    await outbox.reply(update.message, text, LOW)
 
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = load_state()
     user = update.effective_user
-    player = get_or_create_player(state, user)
-    promoters = state.get("promoters", {})
-    promoter_info = promoters.get(str(user.id))
+    async with registry_lock:
+        player = get_or_create_player(store, user)
+        promoter_info = store.promoter(user.id)
 
     text = (
         f"🏆 Your stats, {user.first_name}:\n\n"
-        f"Tables joined: {player['joined_tables']}\n"
-        f"Wins: {player['wins']}\n"
-        f"Referred by: {player['referred_by'] or 'None'}\n\n"
+        f"Tables joined: {player.joined_tables}\n"
+        f"Wins: {player.wins}\n"
+        f"Referred by: {player.referred_by or 'None'}\n\n"
     )
 
     if promoter_info:
         text += (
             "🎯 Promoter stats:\n"
-            f"Referred players: {promoter_info['referred_players']}\n"
-            f"Pending payout: ${promoter_info['pending_payout']:.2f}\n"
-            f"Total paid: ${promoter_info['total_paid']:.2f}\n"
+            f"Referred players: {promoter_info.referred_players}\n"
+            f"Pending payout: ${promoter_info.pending_payout:.2f}\n"
+            f"Total paid: ${promoter_info.total_paid:.2f}\n"
         )
 
-    await update.message.reply_text(text)
+    await outbox.reply(update.message, text, LOW)
+
+
+async def seat_player(user, pool: Pool) -> Optional[Tuple[Table, List[int]]]:
+    """Seat ``user`` at the pool's next waiting table and make it durable.
+
+    Returns the table and everyone now seated at it, or None if the user
+    already sits at the waiting table.
+    """
+    uid = user.id
+
+    # matchmaking and seating must not interleave with another join
+    async with registry_lock:
+        table = find_waiting_table(store, pool)
+        # take the lock before writing anything, as a batch must not span an
+        # await; a table created below is not visible to anyone else yet
+        async with table_lock(table.id) if table else nullcontext():
+            with store.batch():
+                get_or_create_player(store, user)
+                if not table:
+                    table = create_table(store, pool)
+                elif uid in table.players:
+                    return None
+                table = store.join_table(table.id, uid)
+                # records may be live views; take what we need now
+                seated = list(table.players)
+                if len(seated) >= table_terms(table).size:
+                    store.start_table(table.id)
+                    schedule_timeout(table.id, "running")
+                else:
+                    schedule_timeout(table.id, "waiting")
+
+    # whatever acknowledges the seat has to come after it is on disk
+    await store.commit()
+    return table, seated
+
+
+def lobby_view(table_id: int) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    table = store.table(table_id)
+    if table is None or table.status != "waiting":
+        return None
+    terms = table_terms(table)
+    names = []
+    for pid in table.players:
+        p = store.player(pid)
+        names.append((p.first_name or p.username or "Player") if p else "Player")
+    text = (
+        f"🎱 Table #{table_id} – {len(names)}/{terms.size} players\n\n"
+        f"Players: {', '.join(names)}\n\n"
+        f"Buy-in: ${terms.buy_in} to {CASH_TAG}\n"
+        f"Winner gets: ${terms.prize}\n"
+        f"Tap Join or send /join {terms.name} to take a seat."
+    )
+    keyboard = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("Join", callback_data=f"join:{table_id}")]]
+    )
+    return text, keyboard
+
+
+def running_text(table: Table, seated: List[int]) -> str:
+    terms = table_terms(table)
+    mentions = []
+    for pid in seated:
+        p = store.player(pid)
+        if not p:
+            continue
+        uname = p.username
+        if uname:
+            mentions.append(f"@{uname}")
+        else:
+            mentions.append(p.first_name or "Player")
+
+    return (
+        f"🔥 Table #{table.id} is FULL and now RUNNING!\n\n"
+        f"Players: {', '.join(mentions)}\n\n"
+        "Play your 1v1 games and report the FINAL WINNER.\n"
+        f"Admin: use /winner {table.id} @username when done.\n\n"
+        f"Buy-in: ${terms.buy_in} to {CASH_TAG}\n"
+        f"Winner gets: ${terms.prize}"
+    )
+
+
+async def show_seating(
+    chat_id: int, table: Table, seated: List[int], answer: Optional[Answer] = None
+) -> bool:
+    """Update the table's lobby message after a join in ``chat_id``.
+
+    A full table's lobby is closed and the start announcement posted under
+    it, as a new message so that the players it mentions are notified. False
+    if the lobby lives in another chat, so this chat has seen nothing of the
+    join. ``answer`` goes out with the lobby update.
+    """
+    size = table_terms(table).size
+    if len(seated) >= size:
+        text = running_text(table, seated)
+        closed = (
+            f"🎱 Table #{table.id} – {len(seated)}/{size} players\n\n"
+            "Full and now running, see below."
+        )
+        if lobby.close(table.id, closed, answer, announcement=text) != chat_id:
+            await outbox.send(chat_id, text)
+        return True
+    view = partial(lobby_view, table.id)
+    return lobby.update(table.id, chat_id, view, answer) == chat_id
 
 
 async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Player joins the next waiting table."""
+    """Player joins the next waiting table: /join [pool]"""
     if update.effective_chat.type not in ("group", "supergroup"):
-        await update.message.reply_text("Use /join in the main group chat.")
+        await outbox.reply(update.message, "Use /join in the main group chat.", LOW)
+        return
+    args = context.args or []
+    pool = POOLS.get(args[0].lstrip("$")) if args else DEFAULT_POOL
+    if pool is None:
+        await outbox.reply(
+            update.message, f"Unknown pool. Choose one of: {pool_choices()}", LOW
+        )
         return
 
-    state = load_state()
-    user = update.effective_user
-    player = get_or_create_player(state, user)
+    seating = await seat_player(update.effective_user, pool)
+    if seating is None:
+        await outbox.reply(update.message, "You are already in this table.", LOW)
+        return
 
-    table = find_waiting_table(state)
-    if not table:
-        table = create_table(state)
+    table, seated = seating
+    if not await show_seating(update.effective_chat.id, table, seated):
+        await outbox.reply(
+            update.message,
+            f"🎱 {update.effective_user.first_name} joined table #{table.id} "
+            f"({len(seated)}/{table_terms(table).size} players).",
+        )
 
-    uid = str(user.id)
-    if uid in table["players"]:
-        await update.message.reply_text("You are already in this table.")
-        return
 
-    table["players"].append(uid)
-    player["joined_tables"] += 1
-    save_state(state)
+async def join_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """The Join button under a lobby message; seats like /join."""
+    query = update.callback_query
+    if join_taps.seen(query.id):
+        return  # redelivered; the first delivery answers it
+    table_id = int(query.data.split(":", 1)[1])
+    tapped = store.table(table_id)
+    pool = None
+    if tapped is not None:
+        pool = DEFAULT_POOL if tapped.pool is None else POOLS.get(tapped.pool)
+    if pool is None:
+        # archived, or its pool has been removed from the configuration
+        await query.answer("This table is closed, send /join to play.")
+        return
+    key = (query.from_user.id, table_id)
+    earlier = join_taps.earlier(key)
+    if earlier is not None:
+        # a double tap: same answer, no second pass through matchmaking
+        await query.answer(await earlier)
+        return
 
-    current = len(table["players"])
-    remaining = TABLE_SIZE - current
+    try:
+        seating = await seat_player(query.from_user, pool)
+    except Exception:
+        join_taps.forget(key)
+        raise
+    if seating is None:
+        text = "You are already in this table."
+        join_taps.settle(key, text)
+        await query.answer(text)
+        return
 
-    await update.message.reply_text(
-        f"🎱 {user.first_name} joined table #{table['id']} "
-        f"({current}/{TABLE_SIZE} players)."
+    table, seated = seating
+    note = "" if table.id == table_id else f"Table #{table_id} is full. "
+    size = table_terms(table).size
+    text = f"{note}You joined table #{table.id} ({len(seated)}/{size} players)."
+    join_taps.settle(key, text)
+    await show_seating(
+        query.message.chat.id, table, seated, partial(query.answer, text)
     )
 
-    if remaining <= 0:
-        table["status"] = "running"
-        save_state(state)
-        # Announce table start
-        mentions = []
-        for pid in table["players"]:
-            p = state["players"].get(pid)
-            if not p:
-                continue
-            uname = p.get("username")
-            if uname:
-                mentions.append(f"@{uname}")
-            else:
-                mentions.append(p.get("first_name", "Player"))
-
-        text = (
-            f"🔥 Table #{table['id']} is FULL and now RUNNING!\n\n"
-            f"Players: {', '.join(mentions)}\n\n"
-            "Play your 1v1 games and report the FINAL WINNER.\n"
-            f"Admin: use /winner {table['id']} @username when done.\n\n"
-            f"Buy-in: ${BUY_IN} to {CASH_TAG}\n"
-            f"Winner gets: ${WIN_PRIZE}"
-        )
-        await update.message.chat.send_message(text)
+
+TABLE_STATUSES = ("waiting", "running", "finished", "cancelled")
 
 
 async def tables(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/tables [waiting|running|finished] or /tables archive [page]"""
     if update.effective_user.id != ADMIN_ID:
         return
-    state = load_state()
-    if not state["tables"]:
-        await update.message.reply_text("No tables yet.")
+    args = context.args or []
+    if args and args[0] == "archive":
+        await archived_tables(update, args[1:])
         return
+    status = args[0] if args and args[0] in TABLE_STATUSES else None
+
+    def source(after):
+        for t in store.iter_tables(status, after or 0):
+            yield t.id, f"Table #{t.id} – {t.status} – players: {len(t.players)}"
+
+    title = f"📋 Tables ({status})" if status else "📋 Tables"
+    view = pager.open(update.effective_user.id, title, "No tables yet.", source)
+    await send_page(update, view)
+
+
+async def archived_tables(update: Update, args) -> None:
+    total = store.archived_count()
+    pages = max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+    page = int(args[0]) if args and args[0].isdigit() else 1
+    page = min(max(page, 1), pages)
+
+    def source(offset):
+        for t in store.archived_tables(offset, PAGE_SIZE + 1):
+            offset += 1
+            outcome = "expired" if t.status == "cancelled" else f"winner: {t.winner_id}"
+            yield offset, f"Table #{t.id} – {outcome} – players: {len(t.players)}"
+
+    view = pager.open(
+        update.effective_user.id,
+        f"🗄 Archived tables ({total})",
+        "No archived tables yet.",
+        source,
+        start=(page - 1) * PAGE_SIZE,
+        first=page,
+    )
+    await send_page(update, view)
 
-    lines = []
-    for t_id, t in state["tables"].items():
-        lines.append(
-            f"Table #{t['id']} – {t['status']} – players: {len(t['players'])}"
-        )
-    await update.message.reply_text("📋 Tables:\n" + "\n".join(lines))
+
+async def send_page(update: Update, view: Page) -> None:
+    text, markup = view
+    await outbox.reply(update.message, text, HIGH, reply_markup=markup)
+
+
+async def page_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Prev/Next under a listing page; edits the page in place."""
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
+        await query.answer()
+        return
+    _, listing_id, index = query.data.split(":")
+    view = pager.turn(query.from_user.id, int(listing_id), int(index))
+    if view is None:
+        await query.answer("This list has expired, run the command again.")
+        return
+    await query.answer()
+    text, markup = view
+    if text == query.message.text and markup == query.message.reply_markup:
+        return  # a repeated tap; Telegram refuses edits that change nothing
+    await outbox.edit(
+        query.message.chat.id, query.message.message_id, text, HIGH, reply_markup=markup
+    )
 
 
 async def winner(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin marks winner: /winner <table_id> @username"""
+    """Admin marks winner.
+
+    /winner <table_id> @username
+    /winner <table_id> <user_id>
+    or as a reply to the winner's message: /winner <table_id>
+    """
     if update.effective_user.id != ADMIN_ID:
         return
 
-    if len(context.args) < 2:
-        await update.message.reply_text(
-            "Usage: /winner <table_id> @username"
+    replied = update.message.reply_to_message
+    if not context.args or (len(context.args) < 2 and replied is None):
+        await outbox.reply(
+            update.message,
+            "Usage: /winner <table_id> @username|user_id\n"
+            "or reply to the winner's message with /winner <table_id>",
+            HIGH,
         )
         return
 
-    table_id_str = context.args[0]
-    mention = context.args[1]
-
-    state = load_state()
-    table = state["tables"].get(table_id_str)
-    if not table:
-        await update.message.reply_text("Table not found.")
+    if not context.args[0].isdigit():
+        await outbox.reply(update.message, "Table not found.", HIGH)
         return
+    table_id = int(context.args[0])
+
+    # held until the result is durable so a repeated /winner for the same
+    # table sees it finished
+    async with table_lock(table_id):
+        table = store.table(table_id)
+        if not table:
+            await outbox.reply(update.message, "Table not found.", HIGH)
+            return
+
+        if table.status != "running":
+            await outbox.reply(update.message, "Table is not running.", HIGH)
+            return
+
+        winner_uid = resolve_winner(context.args[1:], replied)
+        if winner_uid not in table.players:
+            await outbox.reply(update.message, "Winner not found in this table.", HIGH)
+            return
+
+        with store.batch():
+            # close table and increment winner's stats
+            store.finish_table(table.id, winner_uid)
+            table_timers.cancel(table.id)
+            winner_player = store.player(winner_uid)
+
+            # pay promoter logic: if winner has a "referred_by" promoter, add $2
+            promoter_id = winner_player.referred_by
+            if promoter_id and store.promoter(promoter_id):
+                store.accrue_payout(promoter_id, PROMO_BONUS, table.id)
+        await store.commit()
+
+    winner_name = winner_player.first_name or winner_player.username or "Winner"
 
-    if table["status"] != "running":
-        await update.message.reply_text("Table is not running.")
-        return
+    text = (
+        f"🏆 Table #{table.id} finished!\n"
+        f"Winner: {winner_name}\n\n"
+        f"Prize: ${table_terms(table).prize}\n"
+        f"House keeps: ${table_terms(table).house_cut}\n"
+        f"Promoter bonus (if any): ${PROMO_BONUS:.2f}\n\n"
+        "Run /tables for status or /promostats for promoter balances (admin)."
+    )
+    await outbox.reply(update.message, text, HIGH)
 
-    # try to match winner by username
-    winner_uid = None
-    for pid in table["players"]:
-        p = state["players"].get(pid)
-        if not p:
-            continue
-        uname = p.get("username")
-        if uname and ("@" + uname.lower() == mention.lower()):
-            winner_uid = pid
-            break
 
-    if winner_uid is None:
-        await update.message.reply_text("Winner not found in this table.")
+async def promostats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/promostats [id|balance]"""
+    if update.effective_user.id != ADMIN_ID:
         return
+    args = context.args or []
+    by = args[0] if args and args[0] in PROMOTER_ORDERS else "id"
 
-    table["status"] = "finished"
-    table["winner_id"] = winner_uid
-
-    # increment winner's stats
-    winner_player = state["players"][winner_uid]
-    winner_player["wins"] += 1
-
-    # pay promoter logic: if winner has a "referred_by" promoter, add $2
-    promoter_id = winner_player.get("referred_by")
-    if promoter_id:
-        promoters = state.setdefault("promoters", {})
-        prom = promoters.get(promoter_id)
-        if prom:
-            prom["pending_payout"] += PROMO_BONUS
+    def source(after):
+        for p in store.iter_promoters(by, after):
+            name = p.first_name or p.username or str(p.id)
+            yield promoter_key(by, p), (
+                f"{name}: referred={p.referred_players}, "
+                f"pending=${p.pending_payout:.2f}, "
+                f"paid=${p.total_paid:.2f}"
+            )
 
-    save_state(state)
+    title = "📣 Promoter stats" + (" by balance" if by == "balance" else "")
+    view = pager.open(update.effective_user.id, title, "No promoters yet.", source)
+    await send_page(update, view)
 
-    winner_name = winner_player.get("first_name") or winner_player.get("username") or "Winner"
 
+async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/summary – read from running totals, so it costs the same at any size."""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    totals = store.totals()
+    this_week = totals.house_cut_by_week.get(iso_week(time.time()), 0)
     text = (
-        f"🏆 Table #{table['id']} finished!\n"
-        f"Winner: {winner_name}\n\n"
-        f"Prize: ${WIN_PRIZE}\n"
-        f"House keeps: ${HOUSE_CUT}\n"
-        f"Promoter bonus (if any): ${PROMO_BONUS:.2f}\n\n"
-        "Run /tables for status or /promostats for promoter balances (admin)."
+        "📊 Summary\n"
+        f"Tables: {totals.waiting} waiting, {totals.running} running, "
+        f"{totals.finished} finished, {totals.cancelled} expired\n"
+        f"Prizes owed on running tables: ${totals.prize_liability:.2f}\n"
+        f"Prizes awarded: ${totals.prizes:.2f}\n"
+        f"House cut: ${totals.house_cut:.2f} (this week: ${this_week:.2f})\n"
+        f"Promoter payouts: ${totals.pending_payouts:.2f} pending, "
+        f"${totals.paid_out:.2f} paid"
     )
-    await update.message.reply_text(text)
+    await outbox.reply(update.message, text, HIGH)
 
 
-async def promostats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def settle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/settle – pay every pending promoter balance in one batch."""
     if update.effective_user.id != ADMIN_ID:
         return
-    state = load_state()
-    promoters = state.get("promoters", {})
-    if not promoters:
-        await update.message.reply_text("No promoters yet.")
+    payouts = list(store.settle_payouts().items())
+    await store.commit()
+    if not payouts:
+        await outbox.reply(update.message, "No promoter balances are pending.", HIGH)
         return
 
-    lines = []
-    for p in promoters.values():
-        name = p.get("first_name") or p.get("username") or str(p["id"])
-        lines.append(
-            f"{name}: referred={p['referred_players']}, "
-            f"pending=${p['pending_payout']:.2f}, "
-            f"paid=${p['total_paid']:.2f}"
-        )
+    def source(start):
+        for i, (promoter_id, entry) in enumerate(payouts[start or 0:], start or 0):
+            p = store.promoter(promoter_id)
+            name = p.first_name or p.username or str(p.id)
+            yield i + 1, f"{name}: ${entry.amount:.2f}"
 
-    await update.message.reply_text("📣 Promoter stats:\n" + "\n".join(lines))
+    paid = sum(entry.amount for _, entry in payouts)
+    title = (
+        f"💸 Settlement #{payouts[0][1].batch}: ${paid:.2f} "
+        f"to {len(payouts)} promoter(s)"
+    )
+    view = pager.open(update.effective_user.id, title, "Nothing was paid.", source)
+    await send_page(update, view)
 
 
 # ---------- MAIN ----------
 
-def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN not set in environment variables")
+metrics_server: Optional[HttpServer] = None
 
-    application = Application.builder().token(BOT_TOKEN).build()
 
+async def metrics_endpoint(request: Request) -> Response:
+    return (
+        200,
+        "text/plain; version=0.0.4; charset=utf-8",
+        render_prometheus(outbox).encode("utf-8"),
+    )
+
+
+async def post_init(application: Application) -> None:
+    global bot_username, metrics_server
+    if not STATE_FILE.exists() and LEGACY_STATE_FILE.exists():
+        # the encoding is detected on load, so the old file is usable as is
+        LEGACY_STATE_FILE.rename(STATE_FILE)
+    store.open()
+    schedule_live_tables()
+    # Bot.initialize() has already fetched get_me; keep the answer
+    bot_username = application.bot.username
+    if METRICS_PORT:
+        metrics_server = HttpServer(METRICS_HOST, METRICS_PORT)
+        metrics_server.route("GET", "/metrics", metrics_endpoint)
+        await metrics_server.start()
+    await outbox.start(application.bot)
+
+
+async def post_stop(application: Application) -> None:
+    # updates are no longer processed; deliver what they queued while the
+    # bot can still send
+    try:
+        await asyncio.wait_for(lobby.drain(), OUTBOX_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass  # outbox.stop() reports what is left
+    await outbox.stop(OUTBOX_DRAIN_TIMEOUT)
+
+
+async def post_shutdown(application: Application) -> None:
+    if metrics_server is not None:
+        await metrics_server.stop()
+    store.close()
+
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # move old finished tables out of the live state, then fold the delta
+    # log into a fresh snapshot that no longer carries them
+    store.archive_tables(time.time() - ARCHIVE_AFTER)
+    store.snapshot()
+
+
+async def sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # only tables past their deadline are touched, however many are live
+    for table_id in table_timers.pop_due(time.monotonic()):
+        await sweep_table(table_id)
+
+
+async def run_webhook(application: Application) -> None:
+    """Serve Telegram's webhook from our own HTTP server until SIGINT/SIGTERM.
+
+    Updates posted to WEBHOOK_PATH go straight into the Application's update
+    queue, so a recorded Update JSON can be replayed locally with curl (given
+    the secret header). On shutdown the server stops accepting first, queued
+    updates are processed, and only then is the state flushed and
+    snapshotted.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def telegram_update(request: Request) -> Response:
+        secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            return text_response(403, "forbidden")
+        try:
+            data = json.loads(request.body)
+            # de_json trusts the shape it is given and fails every which way
+            update = (
+                Update.de_json(data, application.bot)
+                if isinstance(data, dict)
+                else None
+            )
+        except (ValueError, TypeError, KeyError, AttributeError):
+            update = None
+        if update is None:
+            return text_response(400, "invalid update")
+        await application.update_queue.put(update)
+        return text_response(200, "ok")
+
+    async def healthz(request: Request) -> Response:
+        if not application.running:
+            return text_response(503, "stopping")
+        return text_response(200, "ok")
+
+    server = HttpServer(WEBHOOK_HOST, WEBHOOK_PORT)
+    server.route("POST", WEBHOOK_PATH, telegram_update)
+    server.route("GET", "/healthz", healthz)
+
+    await application.initialize()
+    await post_init(application)
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    await application.start()
+    await server.start()
+    print(f"Webhook listening on {WEBHOOK_HOST}:{server.port}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+def add_handlers(application: Application) -> None:
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_cmd))
     application.add_handler(CommandHandler("promo", promo))
@@ -401,9 +930,80 @@ def main():
     application.add_handler(CommandHandler("tables", tables))
     application.add_handler(CommandHandler("winner", winner))
     application.add_handler(CommandHandler("promostats", promostats))
+    application.add_handler(CommandHandler("summary", summary))
+    application.add_handler(CommandHandler("settle", settle))
+    application.add_handler(CallbackQueryHandler(join_button, pattern=r"^join:\d+$"))
+    application.add_handler(
+        CallbackQueryHandler(page_button, pattern=r"^page:\d+:\d+$")
+    )
+
+
+# ---------- UPDATE RECORDING ----------
+# Raw incoming updates, one {"t": unix time, "update": ...} JSON object per
+# line, for offline replay with replay.py. The rotating handler keeps the
+# recording bounded to RECORD_BACKUPS + 1 files of RECORD_MAX_BYTES.
+
+update_log = logging.getLogger("poolbot.updates")
+
+
+def enable_recording(application: Application, path: str) -> None:
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=RECORD_MAX_BYTES, backupCount=RECORD_BACKUPS, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    update_log.addHandler(handler)
+    update_log.setLevel(logging.INFO)
+    update_log.propagate = False
+    # group -1 runs before, and independently of, the command handlers
+    application.add_handler(TypeHandler(Update, record_update), group=-1)
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    update_log.info(
+        json.dumps({"t": time.time(), "update": update.to_dict()}, separators=(",", ":"))
+    )
+
+
+def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN not set in environment variables")
+    if BOT_MODE not in ("polling", "webhook"):
+        raise RuntimeError(f"Unknown BOT_MODE: {BOT_MODE}")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set in webhook mode")
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # same pool size PTB uses by default, plus Bot API timing for /metrics
+        .request(TimedRequest(connection_pool_size=256))
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == "webhook":
+        # updates arrive through our own server, not PTB's Updater
+        builder = builder.updater(None)
+    application = builder.build()
+    add_handlers(application)
+    instrument_application(application)
+    if RECORD_UPDATES:
+        enable_recording(application, RECORD_UPDATES)
+
+    application.job_queue.run_repeating(
+        snapshot_job, interval=SNAPSHOT_INTERVAL, first=SNAPSHOT_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        sweep_job, interval=SWEEP_INTERVAL, first=SWEEP_INTERVAL
+    )
 
     print("Bot is starting...")
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,225 @@
+import asyncio
+import contextvars
+import functools
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+if TYPE_CHECKING:
+    from outbox import Outbox
+
+# ---------- METRICS ----------
+# Per-handler counters and latency histograms, exported in the Prometheus
+# text format. Each handler call is split into time spent in the storage
+# layer, time spent waiting on the Bot API, and everything else (compute).
+# Most messages are sent by the outbox worker after the handler returned,
+# so a handler's api phase only covers calls it awaits itself (answering a
+# button tap); every Bot API round trip is also timed per method, and the
+# outbox reports its own queue and delivery latency.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PHASES = ("total", "storage", "api", "compute")
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class HandlerStats:
+    __slots__ = ("calls", "errors", "phases")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.phases = {phase: Histogram() for phase in PHASES}
+
+
+handler_stats: Dict[str, HandlerStats] = {}
+# Bot API method -> round trip times, whichever task made the call
+api_stats: Dict[str, Histogram] = {}
+
+# {"storage": seconds, "api": seconds} for the handler call in progress
+_phase_times: contextvars.ContextVar[Optional[Dict[str, float]]] = (
+    contextvars.ContextVar("phase_times", default=None)
+)
+
+
+def _charge(phase: str, elapsed: float) -> None:
+    times = _phase_times.get()
+    if times is not None:
+        times[phase] += elapsed
+
+
+# ---------- INSTRUMENTATION ----------
+
+def instrument_handler(name: str, callback: Callable) -> Callable:
+    stats = handler_stats.setdefault(name, HandlerStats())
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        times = {"storage": 0.0, "api": 0.0}
+        token = _phase_times.set(times)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            total = time.perf_counter() - start
+            _phase_times.reset(token)
+            stats.calls += 1
+            stats.phases["total"].observe(total)
+            stats.phases["storage"].observe(times["storage"])
+            stats.phases["api"].observe(times["api"])
+            stats.phases["compute"].observe(
+                max(total - times["storage"] - times["api"], 0.0)
+            )
+
+    return wrapper
+
+
+def instrument_application(application: Application) -> None:
+    """Wrap the callback of every handler registered so far."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(
+                handler.callback.__name__, handler.callback
+            )
+
+
+def instrument_storage(store: Any, methods: List[str]) -> None:
+    """Charge time spent in the given store methods to the storage phase."""
+    for name in methods:
+        method = getattr(store, name)
+        if asyncio.iscoroutinefunction(method):
+            setattr(store, name, _timed_async(method))
+        else:
+            setattr(store, name, _timed(method))
+
+
+def _timed(method: Callable) -> Callable:
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _charge("storage", time.perf_counter() - start)
+
+    return wrapper
+
+
+def _timed_async(method: Callable) -> Callable:
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            _charge("storage", time.perf_counter() - start)
+
+    return wrapper
+
+
+class TimedRequest(HTTPXRequest):
+    """Bot API transport that times each round trip by method, and charges
+    it to the api phase of the handler making it, if any."""
+
+    async def do_request(self, url: str, *args, **kwargs) -> Tuple[int, bytes]:
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _charge("api", elapsed)
+            # the last path segment only: the one before it holds the token
+            method = url.rsplit("/", 1)[-1]
+            api_stats.setdefault(method, Histogram()).observe(elapsed)
+
+
+# ---------- EXPOSITION ----------
+
+def _fmt(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _histogram(name: str, labels: str, hist: Histogram) -> List[str]:
+    lines = []
+    sep = "," if labels else ""
+    cumulative = 0
+    for bound, n in zip(BUCKETS, hist.counts):
+        cumulative += n
+        lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {hist.count}')
+    tags = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{tags} {_fmt(hist.sum)}")
+    lines.append(f"{name}_count{tags} {hist.count}")
+    return lines
+
+
+def render_prometheus(outbox: Optional["Outbox"] = None) -> str:
+    lines = [
+        "# HELP poolbot_handler_calls_total Handler invocations.",
+        "# TYPE poolbot_handler_calls_total counter",
+    ]
+    for name, stats in sorted(handler_stats.items()):
+        lines.append(f'poolbot_handler_calls_total{{handler="{name}"}} {stats.calls}')
+    lines += [
+        "# HELP poolbot_handler_errors_total Handler invocations that raised.",
+        "# TYPE poolbot_handler_errors_total counter",
+    ]
+    for name, stats in sorted(handler_stats.items()):
+        lines.append(f'poolbot_handler_errors_total{{handler="{name}"}} {stats.errors}')
+    lines += [
+        "# HELP poolbot_handler_seconds Handler latency by phase "
+        "(total = storage + api + compute).",
+        "# TYPE poolbot_handler_seconds histogram",
+    ]
+    for name, stats in sorted(handler_stats.items()):
+        for phase in PHASES:
+            lines += _histogram(
+                "poolbot_handler_seconds",
+                f'handler="{name}",phase="{phase}"',
+                stats.phases[phase],
+            )
+    lines += [
+        "# HELP poolbot_api_seconds Bot API round trips by method.",
+        "# TYPE poolbot_api_seconds histogram",
+    ]
+    for method, hist in sorted(api_stats.items()):
+        lines += _histogram("poolbot_api_seconds", f'method="{method}"', hist)
+    if outbox is not None:
+        lines += [
+            "# HELP poolbot_outbox_queued Messages waiting in the outbox.",
+            "# TYPE poolbot_outbox_queued gauge",
+            f"poolbot_outbox_queued {outbox.queued}",
+            "# HELP poolbot_outbox_in_flight Messages being sent right now.",
+            "# TYPE poolbot_outbox_in_flight gauge",
+            f"poolbot_outbox_in_flight {outbox.in_flight}",
+            "# HELP poolbot_outbox_messages_total Messages sent, retried and dropped.",
+            "# TYPE poolbot_outbox_messages_total counter",
+            f'poolbot_outbox_messages_total{{result="sent"}} {outbox.sent}',
+            f'poolbot_outbox_messages_total{{result="retried"}} {outbox.retried}',
+            f'poolbot_outbox_messages_total{{result="dropped"}} {outbox.dropped}',
+            "# HELP poolbot_outbox_delivery_seconds From queueing a message to "
+            "Telegram accepting it, pacing and retries included.",
+            "# TYPE poolbot_outbox_delivery_seconds histogram",
+        ]
+        lines += _histogram("poolbot_outbox_delivery_seconds", "", outbox.delivery)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,296 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+# ---------- MODELS ----------
+# Slotted records for the three entity kinds, the running totals and ledger
+# entries. to_dict/from_dict convert to and from the persisted layout;
+# they are spelled out field by field because that is considerably faster
+# than dataclasses.asdict(). All ids are ints; from_dict also accepts the
+# stringified ids older state files used.
+#
+# to_row/from_row are the compact positional form binary snapshots use. Rows
+# written before a field existed are shorter and pick up its default, so new
+# fields go at the end. Both forms copy mutable fields, so a snapshot can be
+# encoded off the event loop while the live records keep changing.
+
+
+def _opt_int(value: Any) -> Optional[int]:
+    return None if value is None else int(value)
+
+
+@dataclass(slots=True)
+class Player:
+    id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    joined_tables: int = 0
+    wins: int = 0
+    referred_by: Optional[int] = None
+    promo_code: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "username": self.username,
+            "first_name": self.first_name,
+            "joined_tables": self.joined_tables,
+            "wins": self.wins,
+            "referred_by": self.referred_by,
+            "promo_code": self.promo_code,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Player":
+        return cls(
+            int(d["id"]),
+            d.get("username"),
+            d.get("first_name"),
+            d.get("joined_tables", 0),
+            d.get("wins", 0),
+            _opt_int(d.get("referred_by")),
+            d.get("promo_code"),
+        )
+
+    def to_row(self) -> tuple:
+        return (
+            self.id,
+            self.username,
+            self.first_name,
+            self.joined_tables,
+            self.wins,
+            self.referred_by,
+            self.promo_code,
+        )
+
+    @classmethod
+    def from_row(cls, row) -> "Player":
+        return cls(*row)
+
+
+@dataclass(slots=True)
+class Promoter:
+    id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    promo_code: str
+    referred_players: int = 0
+    pending_payout: float = 0.0
+    total_paid: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "username": self.username,
+            "first_name": self.first_name,
+            "promo_code": self.promo_code,
+            "referred_players": self.referred_players,
+            "pending_payout": self.pending_payout,
+            "total_paid": self.total_paid,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Promoter":
+        return cls(
+            int(d["id"]),
+            d.get("username"),
+            d.get("first_name"),
+            d.get("promo_code") or f"promo_{d['id']}",
+            d.get("referred_players", 0),
+            d.get("pending_payout", 0.0),
+            d.get("total_paid", 0.0),
+        )
+
+    def to_row(self) -> tuple:
+        return (
+            self.id,
+            self.username,
+            self.first_name,
+            self.promo_code,
+            self.referred_players,
+            self.pending_payout,
+            self.total_paid,
+        )
+
+    @classmethod
+    def from_row(cls, row) -> "Promoter":
+        return cls(*row)
+
+
+@dataclass(slots=True)
+class Table:
+    id: int
+    buy_in: int
+    status: str = "waiting"  # waiting | running | finished | cancelled
+    players: List[int] = field(default_factory=list)
+    winner_id: Optional[int] = None
+    # promoter_user_id -> count of referred players in this table
+    promoters: Dict[int, int] = field(default_factory=dict)
+    finished_at: Optional[float] = None  # unix time the winner was set or it expired
+    # payout split, fixed when the table is created; older tables get the
+    # split of the time filled in on load
+    prize: Optional[int] = None
+    house_cut: Optional[int] = None
+    # pool it was created in and its seat count; None on older tables
+    pool: Optional[str] = None
+    size: Optional[int] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "buy_in": self.buy_in,
+            "players": list(self.players),
+            "winner_id": self.winner_id,
+            # JSON object keys are always strings
+            "promoters": {str(k): v for k, v in self.promoters.items()},
+            "finished_at": self.finished_at,
+            "prize": self.prize,
+            "house_cut": self.house_cut,
+            "pool": self.pool,
+            "size": self.size,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Table":
+        return cls(
+            d["id"],
+            d["buy_in"],
+            d.get("status", "waiting"),
+            [int(uid) for uid in d.get("players", ())],
+            _opt_int(d.get("winner_id")),
+            {int(k): v for k, v in d.get("promoters", {}).items()},
+            d.get("finished_at"),
+            d.get("prize"),
+            d.get("house_cut"),
+            d.get("pool"),
+            d.get("size"),
+        )
+
+    def to_row(self) -> tuple:
+        return (
+            self.id,
+            self.buy_in,
+            self.status,
+            list(self.players),
+            self.winner_id,
+            dict(self.promoters),
+            self.finished_at,
+            self.prize,
+            self.house_cut,
+            self.pool,
+            self.size,
+        )
+
+    @classmethod
+    def from_row(cls, row) -> "Table":
+        return cls(*row)
+
+
+@dataclass(slots=True)
+class Totals:
+    """Running sums over every table and promoter, archived tables included.
+
+    Kept current by the mutations themselves, so summaries never scan;
+    Storage.recompute_totals() derives the same numbers the slow way.
+    """
+
+    pending_payouts: float = 0.0
+    paid_out: float = 0.0
+    prizes: float = 0.0  # awarded to winners
+    house_cut: float = 0.0
+    prize_liability: float = 0.0  # prizes of the tables still running
+    waiting: int = 0
+    running: int = 0
+    finished: int = 0
+    # ISO week ("2024-W07") -> house cut of the tables finished in it
+    house_cut_by_week: Dict[str, float] = field(default_factory=dict)
+    cancelled: int = 0  # expired before they filled up, buy-ins refunded
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "pending_payouts": self.pending_payouts,
+            "paid_out": self.paid_out,
+            "prizes": self.prizes,
+            "house_cut": self.house_cut,
+            "prize_liability": self.prize_liability,
+            "waiting": self.waiting,
+            "running": self.running,
+            "finished": self.finished,
+            "house_cut_by_week": dict(self.house_cut_by_week),
+            "cancelled": self.cancelled,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Totals":
+        return cls(
+            d.get("pending_payouts", 0.0),
+            d.get("paid_out", 0.0),
+            d.get("prizes", 0.0),
+            d.get("house_cut", 0.0),
+            d.get("prize_liability", 0.0),
+            d.get("waiting", 0),
+            d.get("running", 0),
+            d.get("finished", 0),
+            dict(d.get("house_cut_by_week", {})),
+            d.get("cancelled", 0),
+        )
+
+    def to_row(self) -> tuple:
+        return (
+            self.pending_payouts,
+            self.paid_out,
+            self.prizes,
+            self.house_cut,
+            self.prize_liability,
+            self.waiting,
+            self.running,
+            self.finished,
+            dict(self.house_cut_by_week),
+            self.cancelled,
+        )
+
+    @classmethod
+    def from_row(cls, row) -> "Totals":
+        return cls(*row)
+
+
+@dataclass(slots=True)
+class LedgerEntry:
+    """``amount`` moved from account ``credit`` to account ``debit``.
+
+    Entries are only ever appended; see ledger.py for the accounts.
+    """
+
+    id: int
+    at: float  # unix time
+    kind: str  # buy_in | refund | prize | house_cut | promo_bonus | payout | opening
+    debit: str
+    credit: str
+    amount: float
+    table_id: Optional[int] = None
+    batch: Optional[int] = None  # settlement number, on payouts
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "at": self.at,
+            "kind": self.kind,
+            "debit": self.debit,
+            "credit": self.credit,
+            "amount": self.amount,
+            "table_id": self.table_id,
+            "batch": self.batch,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "LedgerEntry":
+        return cls(
+            d["id"],
+            d["at"],
+            d["kind"],
+            d["debit"],
+            d["credit"],
+            d["amount"],
+            d.get("table_id"),
+            d.get("batch"),
+        )
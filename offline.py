@@ -0,0 +1,138 @@
+import itertools
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+# ---------- OFFLINE BOT ----------
+# Lets the real Application and handlers run without touching the network,
+# for benchmarks and traffic replay.
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Pool Bot", "username": "pool_bot"}
+
+
+class StubRequest(BaseRequest):
+    """Answers Bot API calls locally and records every outgoing call."""
+
+    def __init__(self):
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, params))
+        if endpoint == "getMe":
+            result: Any = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": next(self._message_ids),
+                "date": 0,
+                "chat": {"id": params.get("chat_id", 0), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+def offline_application(request: StubRequest) -> Application:
+    return (
+        Application.builder()
+        .token("0:offline")
+        .request(request)
+        .get_updates_request(StubRequest())
+        .updater(None)
+        .build()
+    )
+
+
+# ---------- SYNTHETIC UPDATES ----------
+
+_update_ids = itertools.count(1)
+
+
+def command_update(
+    application: Application,
+    user_id: int,
+    text: str,
+    chat_type: str = "private",
+    chat_id: Optional[int] = None,
+    username: Optional[str] = None,
+) -> Update:
+    """A message Update carrying a bot command, as Telegram would send it."""
+    update_id = next(_update_ids)
+    command = text.split(" ", 1)[0]
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {
+                "id": user_id if chat_id is None else chat_id,
+                "type": chat_type,
+            },
+            "from": {
+                "id": user_id,
+                "is_bot": False,
+                "first_name": f"Player{user_id}",
+                "username": username if username is not None else f"player{user_id}",
+            },
+            "text": text,
+            "entities": [
+                {"type": "bot_command", "offset": 0, "length": len(command)}
+            ],
+        },
+    }
+    return Update.de_json(data, application.bot)
+
+
+def callback_update(
+    application: Application,
+    user_id: int,
+    data: str,
+    chat_id: int,
+    message_id: int = 1,
+    query_id: Optional[str] = None,
+) -> Update:
+    """A tap on an inline button under the bot's message ``message_id``."""
+    update_id = next(_update_ids)
+    payload = {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id) if query_id is None else query_id,
+            "chat_instance": str(chat_id),
+            "data": data,
+            "from": {
+                "id": user_id,
+                "is_bot": False,
+                "first_name": f"Player{user_id}",
+                "username": f"player{user_id}",
+            },
+            "message": {
+                "message_id": message_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "group"},
+                "text": "",
+            },
+        },
+    }
+    return Update.de_json(payload, application.bot)
@@ -0,0 +1,364 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Set, Tuple
+
+from telegram import Bot, Message
+from telegram.constants import ChatType
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter
+
+from metrics import Histogram
+
+# ---------- OUTBOX ----------
+# Every message the bot sends goes through one queue, so bursts (a table
+# filling up, several tables finishing together) are paced to Telegram's
+# flood limits instead of failing handlers with RetryAfter after their state
+# change was already committed. Handlers enqueue and move on; one worker
+# sends, at most one message per chat in flight so a chat sees its messages
+# in order.
+
+HIGH, NORMAL, LOW = 0, 1, 2  # admin / payout, announcements, plain replies
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """``rate`` tokens per second, up to ``burst`` saved; rate 0 = unlimited."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self, now: float) -> bool:
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.burst
+
+    def take(self, now: float) -> None:
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+
+class Outgoing:
+    __slots__ = (
+        "method",
+        "chat_id",
+        "text",
+        "priority",
+        "kwargs",
+        "future",
+        "attempts",
+        "seq",
+        "queued_at",
+    )
+
+    def __init__(self, method, chat_id, text, priority, kwargs, future, seq, queued_at):
+        self.method = method  # Bot method taking chat_id and text
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+        self.seq = seq
+        self.queued_at = queued_at  # loop time
+
+
+class _Chat:
+    __slots__ = ("queue", "bucket", "busy", "blocked_until")
+
+    def __init__(self, bucket: TokenBucket):
+        self.queue: Deque[Outgoing] = deque()
+        self.bucket = bucket
+        self.busy = False
+        self.blocked_until = 0.0
+
+
+class Outbox:
+    """Rate-limited, prioritized send queue.
+
+    Each chat has a token bucket (``chat_rate`` for private chats,
+    ``group_rate`` for groups) and all chats share one of ``global_rate``.
+    The next message sent is the highest-priority head of any chat whose
+    bucket allows it. A RetryAfter pauses all sending for as long as
+    Telegram asks, then the message is retried; network errors are retried
+    with back-off. Only LOW messages are ever dropped: when ``max_queued``
+    messages are waiting, a new message takes the place of the oldest
+    queued LOW one. If none is queued, a LOW message is refused while
+    anything else waits for room.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        burst: float = 3,
+        max_queued: int = 10000,
+        max_attempts: int = 5,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts  # network errors, LOW messages only
+        self.bot: Optional[Bot] = None
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+        self.delivery = Histogram()  # seconds from queueing to sent
+        self._chats: Dict[int, _Chat] = {}
+        self._queued = 0
+        self._seq = itertools.count()
+        self._sending: Set[asyncio.Task] = set()
+        self._paused_until = 0.0
+        self._worker: Optional[asyncio.Task] = None
+        # bound to the running loop in start()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._global: Optional[TokenBucket] = None
+        self._wakeup = self._space = self._idle = None
+
+    async def start(self, bot: Bot) -> None:
+        loop = asyncio.get_running_loop()
+        self.bot = bot
+        self._loop = loop
+        self._global = TokenBucket(self.global_rate, self.global_rate or 1, loop.time())
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._worker = asyncio.create_task(self._run())
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._sending)
+
+    async def drain(self) -> None:
+        """Wait until every queued message has been sent or given up on."""
+        await self._idle.wait()
+
+    async def stop(self, timeout: float) -> None:
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(
+                "outbox stopped with %d messages unsent", self._queued + len(self._sending)
+            )
+        self._worker.cancel()
+        for task in list(self._sending):
+            task.cancel()
+        await asyncio.gather(self._worker, *self._sending, return_exceptions=True)
+        self._worker = None
+
+    # ---------- enqueueing ----------
+
+    async def send(
+        self, chat_id: int, text: str, priority: int = NORMAL, **kwargs: Any
+    ) -> Optional[asyncio.Future]:
+        """Queue a sendMessage; the future resolves to the Message, or None if
+        the message was dropped."""
+        return await self._enqueue("send_message", chat_id, text, priority, kwargs)
+
+    async def edit(
+        self,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        priority: int = NORMAL,
+        **kwargs: Any,
+    ) -> Optional[asyncio.Future]:
+        """Queue an editMessageText; edits count against the same limits."""
+        kwargs["message_id"] = message_id
+        return await self._enqueue("edit_message_text", chat_id, text, priority, kwargs)
+
+    async def _enqueue(
+        self, method: str, chat_id: int, text: str, priority: int, kwargs: Dict[str, Any]
+    ) -> Optional[asyncio.Future]:
+        while self._queued >= self.max_queued:
+            if self._evict_low():
+                break
+            if priority == LOW:
+                self.dropped += 1
+                logger.warning("outbox full, dropping message to %s", chat_id)
+                return None
+            self._space.clear()
+            await self._space.wait()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            rate = self.chat_rate if chat_id > 0 else self.group_rate
+            chat = self._chats[chat_id] = _Chat(
+                TokenBucket(rate, self.burst, self._loop.time())
+            )
+        msg = Outgoing(
+            method,
+            chat_id,
+            text,
+            priority,
+            kwargs,
+            self._loop.create_future(),
+            next(self._seq),
+            self._loop.time(),
+        )
+        chat.queue.append(msg)
+        self._queued += 1
+        self._idle.clear()
+        self._wakeup.set()
+        return msg.future
+
+    async def reply(
+        self, message: Message, text: str, priority: int = NORMAL, **kwargs: Any
+    ) -> Optional[asyncio.Future]:
+        """Like Message.reply_text: quotes the message outside private chats."""
+        if message.chat.type != ChatType.PRIVATE:
+            kwargs.setdefault("reply_to_message_id", message.message_id)
+            # still deliver if the command message was deleted meanwhile
+            kwargs.setdefault("allow_sending_without_reply", True)
+        return await self.send(message.chat_id, text, priority, **kwargs)
+
+    def _evict_low(self) -> bool:
+        oldest: Optional[Tuple[int, _Chat, Outgoing]] = None
+        for chat in self._chats.values():
+            # a chat's queue is in order, so its first LOW message is its oldest
+            msg = next((m for m in chat.queue if m.priority == LOW), None)
+            if msg is not None and (oldest is None or msg.seq < oldest[0]):
+                oldest = (msg.seq, chat, msg)
+        if oldest is None:
+            return False
+        _, chat, msg = oldest
+        chat.queue.remove(msg)
+        self._queued -= 1
+        self.dropped += 1
+        logger.warning("outbox full, dropped queued message to %s", msg.chat_id)
+        self._finish(msg, None)
+        return True
+
+    # ---------- sending ----------
+
+    async def _run(self) -> None:
+        while True:
+            now = self._loop.time()
+            delay = max(self._paused_until - now, self._global.wait_time(now))
+            if delay <= 0:
+                chat, delay = self._pick(now)
+                if chat is not None:
+                    self._dispatch(chat, now)
+                    continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), None if delay == float("inf") else delay
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def _pick(self, now: float) -> Tuple[Optional[_Chat], float]:
+        """Best chat that may send now, else how long until one may."""
+        best: Optional[_Chat] = None
+        best_key = None
+        wait = float("inf")
+        idle = []
+        for chat_id, chat in self._chats.items():
+            if chat.busy:
+                continue
+            if not chat.queue:
+                # forget quiet chats once their bucket has refilled
+                if chat.bucket.full(now):
+                    idle.append(chat_id)
+                continue
+            delay = max(chat.bucket.wait_time(now), chat.blocked_until - now)
+            if delay > 0:
+                wait = min(wait, delay)
+                continue
+            head = chat.queue[0]
+            key = (head.priority, head.seq)
+            if best_key is None or key < best_key:
+                best, best_key = chat, key
+        for chat_id in idle:
+            del self._chats[chat_id]
+        return best, wait
+
+    def _dispatch(self, chat: _Chat, now: float) -> None:
+        msg = chat.queue.popleft()
+        self._queued -= 1
+        self._space.set()
+        chat.bucket.take(now)
+        self._global.take(now)
+        chat.busy = True
+        task = asyncio.create_task(self._deliver(chat, msg))
+        self._sending.add(task)
+        task.add_done_callback(self._sent)
+
+    def _sent(self, task: asyncio.Task) -> None:
+        self._sending.discard(task)
+        if not self._queued and not self._sending:
+            self._idle.set()
+
+    async def _deliver(self, chat: _Chat, msg: Outgoing) -> None:
+        try:
+            result = await getattr(self.bot, msg.method)(
+                chat_id=msg.chat_id, text=msg.text, **msg.kwargs
+            )
+        except RetryAfter as e:
+            # Telegram doesn't say which limit was hit, so back off entirely
+            self._paused_until = max(self._paused_until, self._loop.time() + e.retry_after)
+            self._retry(chat, msg)
+        except ChatMigrated as e:
+            # the group became a supergroup with a new id
+            msg.chat_id = e.new_chat_id
+            self._retry(chat, msg)
+        except (BadRequest, Forbidden) as e:
+            logger.warning("dropping message to %s: %s", msg.chat_id, e)
+            self._finish(msg, None)
+        except NetworkError as e:
+            msg.attempts += 1
+            if msg.priority == LOW and msg.attempts >= self.max_attempts:
+                logger.warning("giving up on message to %s: %s", msg.chat_id, e)
+                self._finish(msg, None)
+            else:
+                chat.blocked_until = self._loop.time() + min(2 ** msg.attempts, 30)
+                self._retry(chat, msg)
+        except Exception:
+            logger.exception("sending to %s failed", msg.chat_id)
+            self._finish(msg, None)
+        else:
+            self.sent += 1
+            self.delivery.observe(self._loop.time() - msg.queued_at)
+            self._finish(msg, result)
+        finally:
+            chat.busy = False
+            self._wakeup.set()
+
+    def _retry(self, chat: _Chat, msg: Outgoing) -> None:
+        chat.queue.appendleft(msg)
+        self._queued += 1
+        self.retried += 1
+
+    @staticmethod
+    def _finish(msg: Outgoing, result: Optional[Message]) -> None:
+        if not msg.future.done():
+            msg.future.set_result(result)
@@ -0,0 +1,108 @@
+import itertools
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# ---------- PAGING ----------
+# Long admin listings go out one page at a time with Prev/Next buttons. A
+# listing reads from a source: given the cursor a page starts at, it yields
+# (cursor just past this item, line) lazily, in listing order. A page pulls
+# at most page_size + 1 items, so it costs the same however long the listing
+# gets. Each admin keeps the start cursors of the pages they have seen in
+# the listing they opened last; buttons of older listings expire.
+
+Source = Callable[[Any], Iterable[Tuple[Any, str]]]
+Page = Tuple[str, Optional[InlineKeyboardMarkup]]
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit for a text message
+
+
+class _Listing:
+    __slots__ = ("id", "title", "empty", "source", "starts", "index", "first")
+
+    def __init__(
+        self,
+        listing_id: int,
+        title: str,
+        empty: str,
+        source: Source,
+        start: Any,
+        first: int,
+    ):
+        self.id = listing_id
+        self.title = title
+        self.empty = empty  # shown instead of a page without lines
+        self.source = source
+        self.starts: List[Any] = [start]  # cursor each seen page starts at
+        self.index = 0  # page shown
+        self.first = first  # number of the first page, for the header
+
+
+class Pager:
+    def __init__(self, page_size: int = 20, max_chars: int = MAX_MESSAGE_LENGTH):
+        self.page_size = page_size
+        self.max_chars = max_chars
+        self._listings: Dict[int, _Listing] = {}  # owner -> listing opened last
+        # not reused after a restart, so buttons sent before it expire
+        self._ids = itertools.count(int(time.time()))
+
+    def open(
+        self,
+        owner: int,
+        title: str,
+        empty: str,
+        source: Source,
+        start: Any = None,
+        first: int = 1,
+    ) -> Page:
+        """First page of a new listing for ``owner``, numbered ``first``."""
+        listing = _Listing(next(self._ids), title, empty, source, start, first)
+        self._listings[owner] = listing
+        return self._render(listing)
+
+    def turn(self, owner: int, listing_id: int, index: int) -> Optional[Page]:
+        """Page ``index`` of the owner's listing; None if it has expired."""
+        listing = self._listings.get(owner)
+        if listing is None or listing.id != listing_id:
+            return None
+        if 0 <= index < len(listing.starts):
+            listing.index = index
+        return self._render(listing)
+
+    def _render(self, listing: _Listing) -> Page:
+        index = listing.index
+        header = f"{listing.title}, page {listing.first + index}:"
+        lines: List[str] = []
+        size = len(header)
+        more = False
+        end = None
+        for cursor, line in listing.source(listing.starts[index]):
+            if lines and (
+                len(lines) == self.page_size or size + 1 + len(line) > self.max_chars
+            ):
+                more = True
+                break
+            line = line[: self.max_chars - size - 1]
+            lines.append(line)
+            size += 1 + len(line)
+            end = cursor
+        del listing.starts[index + 1:]
+        if more:
+            listing.starts.append(end)
+        elif index == 0 and listing.first == 1:
+            header = f"{listing.title}:"  # it all fits on one page
+
+        buttons = []
+        if index > 0:
+            buttons.append(self._button("« Prev", listing, index - 1))
+        if more:
+            buttons.append(self._button("Next »", listing, index + 1))
+        markup = InlineKeyboardMarkup([buttons]) if buttons else None
+        if not lines:
+            return listing.empty, markup
+        return "\n".join([header] + lines), markup
+
+    @staticmethod
+    def _button(label: str, listing: _Listing, index: int) -> InlineKeyboardButton:
+        return InlineKeyboardButton(label, callback_data=f"page:{listing.id}:{index}")
@@ -0,0 +1,45 @@
+from dataclasses import dataclass
+from typing import Dict
+
+# ---------- TABLE POOLS ----------
+# A pool is one kind of table: seat count, buy-in and payout split. Every
+# pool fills its own tables from its own waiting queue, so pools run side by
+# side. Tables keep the terms they were created with; changing a pool's
+# configuration only affects its next tables.
+
+
+@dataclass(frozen=True, slots=True)
+class Pool:
+    name: str  # what players type after /join
+    size: int
+    buy_in: int
+    prize: int
+    house_cut: int
+
+
+def parse_pools(spec: str) -> Dict[str, Pool]:
+    """``name:size:buy_in:prize:house_cut`` entries, comma-separated.
+
+    The first pool is the default one. Prize and house cut must add up to
+    what a full table brings in.
+    """
+    pools: Dict[str, Pool] = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        try:
+            name, *numbers = item.strip().split(":")
+            size, buy_in, prize, house_cut = (int(n) for n in numbers)
+        except ValueError:
+            raise ValueError(
+                f"Bad table pool {item!r}, expected name:size:buy_in:prize:house_cut"
+            ) from None
+        if size < 2 or prize + house_cut != size * buy_in:
+            raise ValueError(
+                f"Table pool {name!r}: needs 2+ seats, and prize + house cut "
+                "must equal size x buy-in"
+            )
+        pools[name] = Pool(name, size, buy_in, prize, house_cut)
+    if not pools:
+        raise ValueError("No table pools configured")
+    return pools
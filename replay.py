@@ -0,0 +1,172 @@
+"""Replay recorded Updates against a fresh state directory.
+
+Feeds updates captured with RECORD_UPDATES through the same handlers as the
+live bot, with a stubbed Bot API that records outgoing messages instead of
+sending them:
+
+    python replay.py data/updates.jsonl.1 data/updates.jsonl --speed 10
+
+--speed 1 keeps the original timing (updates overlap as they did in
+production), --speed 10 is ten times faster, --speed 0 replays back to back
+without overlap. The report covers throughput, per-update latency, outgoing
+calls and the final state. --dump saves the final state and --expect diffs
+it against an earlier dump, so two storage or concurrency variants can be
+checked against the same traffic.
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+from telegram import Update
+
+import main
+from bench import open_store, percentile
+from offline import StubRequest, offline_application
+from lobby import Lobby
+from outbox import Outbox
+from storage import Storage
+
+
+def read_recording(paths: List[Path]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def export_state(store: Storage) -> Dict[str, Dict[str, Any]]:
+    return {
+        "players": {str(p.id): p.to_dict() for p in store.iter_players()},
+        "promoters": {str(p.id): p.to_dict() for p in store.iter_promoters()},
+        "tables": {str(t.id): t.to_dict() for t in store.iter_tables()},
+    }
+
+
+def state_diff(
+    expected: Dict[str, Dict[str, Any]], actual: Dict[str, Dict[str, Any]]
+) -> Dict[str, Dict[str, List[str]]]:
+    diff = {}
+    for section in ("players", "promoters", "tables"):
+        old, new = expected.get(section, {}), actual.get(section, {})
+        diff[section] = {
+            "added": sorted(new.keys() - old.keys()),
+            "removed": sorted(old.keys() - new.keys()),
+            "changed": sorted(k for k in old.keys() & new.keys() if old[k] != new[k]),
+        }
+    return diff
+
+
+async def replay(args) -> Dict[str, Any]:
+    records = list(read_recording(args.recordings))
+    if not records:
+        raise SystemExit("no updates in recording")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or Path(tmp)
+        data_dir.mkdir(parents=True, exist_ok=True)
+        store = open_store(args.backend, data_dir)
+
+        request = StubRequest()
+        app = offline_application(request)
+        main.add_handlers(app)
+        errors: List[str] = []
+
+        async def on_error(update: object, context) -> None:
+            errors.append(repr(context.error))
+
+        app.add_error_handler(on_error)
+        await app.initialize()
+        main.store = store
+        main.bot_username = app.bot.username
+        # the stub API has no flood limits, so don't pace replies
+        main.outbox = Outbox(global_rate=0, chat_rate=0, group_rate=0)
+        await main.outbox.start(app.bot)
+        main.lobby = Lobby(main.outbox, main.LOBBY_DEBOUNCE_MS / 1000)
+
+        latencies: List[float] = []
+
+        async def run_one(record: Dict[str, Any]) -> None:
+            update = Update.de_json(record["update"], app.bot)
+            t0 = time.perf_counter()
+            await app.process_update(update)
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+        started = time.perf_counter()
+        if args.speed <= 0:
+            for record in records:
+                await run_one(record)
+        else:
+            first = records[0]["t"]
+            tasks = []
+            for record in records:
+                delay = (record["t"] - first) / args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(run_one(record)))
+            await asyncio.gather(*tasks)
+        await main.lobby.drain()
+        await main.outbox.stop(5)
+        store.drain()
+        elapsed = time.perf_counter() - started
+
+        final = export_state(store)
+        await app.shutdown()
+        store.close()
+
+    latencies.sort()
+    report: Dict[str, Any] = {
+        "updates": len(records),
+        "recorded_span_s": records[-1]["t"] - records[0]["t"],
+        "replay_s": elapsed,
+        "throughput_ups": len(records) / elapsed if elapsed else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1],
+        },
+        "errors": errors,
+        "outgoing": dict(Counter(endpoint for endpoint, _ in request.calls)),
+        "state": {section: len(rows) for section, rows in final.items()},
+    }
+    if args.expect:
+        expected = json.loads(args.expect.read_text(encoding="utf-8"))
+        report["diff"] = state_diff(expected, final)
+    if args.dump:
+        args.dump.write_text(json.dumps(final, indent=2, sort_keys=True), encoding="utf-8")
+    if args.messages:
+        with args.messages.open("w", encoding="utf-8") as f:
+            for endpoint, params in request.calls:
+                f.write(json.dumps({"method": endpoint, "params": params}, default=str) + "\n")
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("recordings", nargs="+", type=Path,
+                        help="recording files, oldest first")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="1 = original timing, 0 = back to back (default)")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--data-dir", type=Path, default=None,
+                        help="keep the replayed state here instead of a temp dir")
+    parser.add_argument("--dump", type=Path, help="write the final state here")
+    parser.add_argument("--expect", type=Path, help="diff the final state against this dump")
+    parser.add_argument("--messages", type=Path, help="write outgoing Bot API calls here")
+    parser.add_argument("--out", type=Path, help="write the report here as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(replay(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        args.out.write_text(text, encoding="utf-8")
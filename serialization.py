@@ -0,0 +1,120 @@
+import io
+import json
+import pickle
+from typing import Any, Dict, Optional
+
+try:
+    import msgpack
+except ImportError:  # optional; pickle is the stdlib binary fallback
+    msgpack = None
+
+# ---------- SNAPSHOT SERIALIZERS ----------
+# Encodings for the snapshot payload (plain dicts, lists, strings and
+# numbers). Binary encodings start with their own magic bytes, so a snapshot
+# written with any of them can be loaded without knowing which one it was.
+
+
+class Serializer:
+    name = ""
+    magic = b""
+    rows = False  # records as positional rows instead of dicts (storage.py)
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonSerializer(Serializer):
+    """Compact JSON; readable, but the largest and slowest option."""
+
+    name = "json"
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class MsgpackSerializer(Serializer):
+    name = "msgpack"
+    magic = b"PBSNAP\x00M"
+    rows = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        # table rows carry int-keyed promoter counts
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class _DataUnpickler(pickle.Unpickler):
+    # snapshots only ever hold plain data; refusing every global means a
+    # tampered file cannot make loading run code
+    def find_class(self, module: str, name: str) -> Any:
+        raise pickle.UnpicklingError(f"unexpected {module}.{name} in snapshot")
+
+
+class PickleSerializer(Serializer):
+    """Stdlib binary encoding, used when msgpack is not installed."""
+
+    name = "pickle"
+    magic = b"PBSNAP\x00P"
+    rows = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return pickle.dumps(obj, protocol=5)
+
+    def loads(self, data: bytes) -> Any:
+        return _DataUnpickler(io.BytesIO(data)).load()
+
+
+SERIALIZERS: Dict[str, Serializer] = {
+    s.name: s for s in (JsonSerializer(), MsgpackSerializer(), PickleSerializer())
+}
+
+
+def available() -> Dict[str, Serializer]:
+    return {
+        name: s for name, s in SERIALIZERS.items() if name != "msgpack" or msgpack
+    }
+
+
+def get_serializer(name: str) -> Serializer:
+    """Serializer by name; "binary" picks the best one installed."""
+    if name == "binary":
+        name = "msgpack" if msgpack is not None else "pickle"
+    if name not in SERIALIZERS:
+        raise RuntimeError(f"Unknown snapshot serializer: {name}")
+    if name == "msgpack" and msgpack is None:
+        raise RuntimeError("The msgpack serializer needs the msgpack package")
+    return SERIALIZERS[name]
+
+
+def encode(serializer: Serializer, obj: Any) -> bytes:
+    return serializer.magic + serializer.dumps(obj)
+
+
+def detect(data: bytes) -> Optional[Serializer]:
+    for serializer in SERIALIZERS.values():
+        if serializer.magic and data.startswith(serializer.magic):
+            return serializer
+    if data.lstrip()[:1] == b"{":
+        return SERIALIZERS["json"]
+    return None
+
+
+def decode(data: bytes) -> Any:
+    """Load a snapshot written by any serializer; ValueError if unreadable."""
+    serializer = detect(data)
+    if serializer is None:
+        raise ValueError("unrecognized snapshot encoding")
+    if serializer.name == "msgpack" and msgpack is None:
+        raise RuntimeError("snapshot is msgpack-encoded but msgpack is not installed")
+    try:
+        return serializer.loads(data[len(serializer.magic):])
+    except Exception as e:
+        raise ValueError(f"corrupt {serializer.name} snapshot: {e}") from e
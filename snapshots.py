@@ -0,0 +1,153 @@
+"""Convert state snapshots between encodings and benchmark the encodings.
+
+    python snapshots.py convert data/state.snapshot --to json
+    python snapshots.py bench --sizes 10000,100000
+
+convert re-encodes a snapshot in place (or into --out); stop the bot first.
+The input encoding is detected. Snapshots from before running totals get
+them recomputed from the snapshot and the archive next to it. bench builds synthetic states with the
+bench.py population and reports snapshot size and encode/decode time per
+serializer, end to end (models <-> bytes).
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from bench import open_store, populate
+from models import Totals
+from serialization import available, detect, encode, get_serializer
+from storage import read_snapshot, snapshot_payload
+
+
+def recompute_totals(snapshot: Path) -> Totals:
+    """Totals as the bot would compute them on opening this snapshot.
+
+    The store is opened on a copy without the WAL, so the totals are as of
+    the snapshot and the bot replays the WAL on top of them as usual.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = Path(tmp)
+        shutil.copyfile(snapshot, data_dir / "state.snapshot")
+        for name in ("tables.archive.jsonl", "ledger.jsonl"):
+            if (snapshot.parent / name).exists():
+                shutil.copyfile(snapshot.parent / name, data_dir / name)
+        store = open_store("json", data_dir)
+        try:
+            return store.totals()
+        finally:
+            store.close()
+
+
+def convert(args) -> None:
+    source = detect(args.snapshot.read_bytes())
+    state, seq = read_snapshot(args.snapshot)
+    if state["totals"] is None:
+        state["totals"] = recompute_totals(args.snapshot)
+    target = get_serializer(args.to)
+    out = args.out or args.snapshot
+    tmp = out.with_suffix(".tmp")
+    with tmp.open("wb") as f:
+        f.write(encode(target, snapshot_payload(state, seq, target)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, out)
+    print(
+        f"{args.snapshot} ({source.name}) -> "
+        f"{out} ({target.name}, {out.stat().st_size} B)"
+    )
+
+
+def timed(fn, repeat: int) -> float:
+    """Best wall time of ``repeat`` calls, in milliseconds."""
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        runs.append((time.perf_counter() - t0) * 1000)
+    return min(runs)
+
+
+def bench_size(size: int, args) -> List[Dict[str, Any]]:
+    with tempfile.TemporaryDirectory() as tmp:
+        store = open_store("json", Path(tmp))
+        asyncio.run(populate(store, size, int(size * args.table_ratio), size // 10, 0))
+        state = store.state
+        store.close()
+
+        results = []
+        for name, serializer in available().items():
+            path = Path(tmp) / f"state.{name}"
+            path.write_bytes(encode(serializer, snapshot_payload(state, 0, serializer)))
+            results.append({
+                "size": size,
+                "serializer": name,
+                "bytes": path.stat().st_size,
+                "encode_ms": timed(
+                    lambda: encode(serializer, snapshot_payload(state, 0, serializer)),
+                    args.repeat,
+                ),
+                "decode_ms": timed(lambda: read_snapshot(path), args.repeat),
+            })
+    base = next(r for r in results if r["serializer"] == "json")
+    for r in results:
+        r["size_ratio"] = base["bytes"] / r["bytes"]
+        r["encode_speedup"] = base["encode_ms"] / r["encode_ms"]
+        r["decode_speedup"] = base["decode_ms"] / r["decode_ms"]
+    return results
+
+
+def bench(args) -> None:
+    results = []
+    for size in args.sizes:
+        results.extend(bench_size(size, args))
+    header = (
+        f"{'size':>8} {'serializer':<10} {'KiB':>10} {'encode ms':>10} "
+        f"{'decode ms':>10} {'smaller':>8} {'enc x':>6} {'dec x':>6}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['size']:>8} {r['serializer']:<10} {r['bytes'] / 1024:>10.1f} "
+            f"{r['encode_ms']:>10.1f} {r['decode_ms']:>10.1f} {r['size_ratio']:>8.2f} "
+            f"{r['encode_speedup']:>6.2f} {r['decode_speedup']:>6.2f}"
+        )
+    if args.out:
+        args.out.write_text(
+            json.dumps({"repeat": args.repeat, "results": results}, indent=2),
+            encoding="utf-8",
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("convert", help="re-encode a snapshot")
+    p.add_argument("snapshot", type=Path)
+    p.add_argument("--to", required=True,
+                   help="json, msgpack, pickle or binary (best installed)")
+    p.add_argument("--out", type=Path, help="write here instead of in place")
+    p.set_defaults(run=convert)
+
+    p = sub.add_parser("bench", help="compare serializers on synthetic states")
+    p.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")],
+                   default=[10000, 100000], help="comma-separated player counts")
+    p.add_argument("--table-ratio", type=float, default=1.0,
+                   help="finished tables per player (default: 1.0)")
+    p.add_argument("--repeat", type=int, default=3,
+                   help="best of this many runs (default: 3)")
+    p.add_argument("--out", type=Path, help="write the results here as JSON")
+    p.set_defaults(run=bench)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.run(args)
@@ -0,0 +1,1887 @@
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from ledger import (
+    HOUSE,
+    PAYOUTS,
+    player_account,
+    promoter_account,
+    table_account,
+)
+from models import LedgerEntry, Player, Promoter, Table, Totals
+from serialization import Serializer, decode, encode, get_serializer
+
+# 2: integer ids in values (format 1 stringified them)
+# 3: every table carries its payout split (older ones are backfilled)
+SNAPSHOT_FORMAT = 3
+
+# ---------- STATE LAYOUT ----------
+
+def empty_state() -> Dict[str, Any]:
+    return {
+        "tables": {},        # table_id -> Table
+        "next_table_id": 1,
+        "players": {},       # user_id -> Player
+        "promoters": {},     # user_id -> Promoter
+        "archive_size": 0,   # bytes of the table archive this state accounts for
+        "totals": Totals(),
+        "ledger_size": 0,    # bytes of the ledger this state accounts for
+        "ledger_entries": 0,  # id of the last ledger entry
+        "settlements": 0,    # number of the last settlement
+    }
+
+
+# Tables from before each table stored its payout split all paid the one
+# split the bot had then; they get it filled in wherever they are loaded.
+LEGACY_PRIZE = 20
+LEGACY_HOUSE_CUT = 5
+
+
+def _backfill_terms(table: Table) -> Table:
+    if table.prize is None:
+        table.prize, table.house_cut = LEGACY_PRIZE, LEGACY_HOUSE_CUT
+    return table
+
+
+# In memory every id is an int. JSON only has string object keys, so ids are
+# stringified on the way out and parsed on the way in, here and nowhere else.
+# Snapshots from before totals were kept load with "totals" None; the store
+# recomputes them on open.
+
+def state_from_dict(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """Persisted layout (plain dicts) -> in-memory layout (models)."""
+    return {
+        "tables": {
+            int(k): _backfill_terms(Table.from_dict(v))
+            for k, v in raw.get("tables", {}).items()
+        },
+        "next_table_id": raw.get("next_table_id", 1),
+        "players": {
+            int(k): Player.from_dict(v) for k, v in raw.get("players", {}).items()
+        },
+        "promoters": {
+            int(k): Promoter.from_dict(v) for k, v in raw.get("promoters", {}).items()
+        },
+        "archive_size": raw.get("archive_size", 0),
+        "totals": Totals.from_dict(raw["totals"]) if "totals" in raw else None,
+        "ledger_size": raw.get("ledger_size", 0),
+        "ledger_entries": raw.get("ledger_entries", 0),
+        "settlements": raw.get("settlements", 0),
+    }
+
+
+def state_to_dict(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "tables": {str(k): v.to_dict() for k, v in state["tables"].items()},
+        "next_table_id": state["next_table_id"],
+        "players": {str(k): v.to_dict() for k, v in state["players"].items()},
+        "promoters": {str(k): v.to_dict() for k, v in state["promoters"].items()},
+        "archive_size": state["archive_size"],
+        "totals": state["totals"].to_dict(),
+        "ledger_size": state["ledger_size"],
+        "ledger_entries": state["ledger_entries"],
+        "settlements": state["settlements"],
+    }
+
+
+# Binary snapshots store each record as a row of field values instead (see
+# models.py), which skips repeating every field name once per record.
+
+def state_from_rows(raw: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "tables": {
+            row[0]: _backfill_terms(Table.from_row(row)) for row in raw["tables"]
+        },
+        "next_table_id": raw["next_table_id"],
+        "players": {row[0]: Player.from_row(row) for row in raw["players"]},
+        "promoters": {row[0]: Promoter.from_row(row) for row in raw["promoters"]},
+        "archive_size": raw["archive_size"],
+        "totals": Totals.from_row(raw["totals"]) if "totals" in raw else None,
+        "ledger_size": raw.get("ledger_size", 0),
+        "ledger_entries": raw.get("ledger_entries", 0),
+        "settlements": raw.get("settlements", 0),
+    }
+
+
+class SnapshotCache:
+    """Encoded records of the previous snapshot, refreshed where they changed.
+
+    Most of a snapshot's cost is turning every record into a dict or row.
+    Encoded records are never modified afterwards, so they are kept between
+    snapshots and only the ids touched by delta records since the last one
+    are encoded again.
+    """
+
+    SECTIONS = ("players", "promoters", "tables")
+
+    def __init__(self, rows: bool):
+        self.rows = rows
+        self._encoded: Dict[str, Dict[Any, Any]] = {s: {} for s in self.SECTIONS}
+        self._dirty: Dict[str, set] = {s: set() for s in self.SECTIONS}
+
+    def touch_all(self, state: Dict[str, Any]) -> None:
+        for section, dirty in self._dirty.items():
+            dirty.update(state[section])
+
+    def touch(self, rec: Dict[str, Any]) -> None:
+        # over-marking is harmless: a clean record is just encoded again
+        if "uid" in rec:
+            self._dirty["players"].add(rec["uid"])
+            self._dirty["promoters"].add(rec["uid"])
+        if "evicted" in rec:
+            self._dirty["players"].add(rec["evicted"])
+        if "promoter_id" in rec:
+            self._dirty["promoters"].add(rec["promoter_id"])
+        if "table_id" in rec:
+            self._dirty["tables"].add(rec["table_id"])
+        if "table_ids" in rec:
+            self._dirty["tables"].update(rec["table_ids"])
+        if "payouts" in rec:
+            self._dirty["promoters"].update(pid for pid, _ in rec["payouts"])
+
+    def payload(self, state: Dict[str, Any], seq: int) -> Dict[str, Any]:
+        for section, dirty in self._dirty.items():
+            live, encoded = state[section], self._encoded[section]
+            for record_id in dirty:
+                key = record_id if self.rows else str(record_id)
+                record = live.get(record_id)
+                if record is None:
+                    encoded.pop(key, None)
+                elif self.rows:
+                    encoded[key] = record.to_row()
+                else:
+                    encoded[key] = record.to_dict()
+            dirty.clear()
+        # in the live state's order, not the cache's: tables must come back
+        # in id order (see iter_tables)
+        if self.rows:
+            raw = {
+                section: [encoded[k] for k in state[section]]
+                for section, encoded in self._encoded.items()
+            }
+        else:
+            raw = {
+                section: {k: encoded[k] for k in map(str, state[section])}
+                for section, encoded in self._encoded.items()
+            }
+        raw["next_table_id"] = state["next_table_id"]
+        raw["archive_size"] = state["archive_size"]
+        totals = state["totals"]
+        raw["totals"] = totals.to_row() if self.rows else totals.to_dict()
+        for key in ("ledger_size", "ledger_entries", "settlements"):
+            raw[key] = state[key]
+        payload = {"format": SNAPSHOT_FORMAT, "seq": seq, "state": raw}
+        if self.rows:
+            payload["layout"] = "rows"
+        return payload
+
+
+def snapshot_payload(
+    state: Dict[str, Any], seq: int, serializer: Serializer
+) -> Dict[str, Any]:
+    cache = SnapshotCache(serializer.rows)
+    cache.touch_all(state)
+    return cache.payload(state, seq)
+
+
+def read_snapshot(path: Path) -> Tuple[Dict[str, Any], int]:
+    """Load a snapshot in any encoding; returns (state, seq)."""
+    try:
+        payload = decode(path.read_bytes())
+    except ValueError as e:
+        raise RuntimeError(
+            f"{path} is corrupt; refusing to start with an empty state"
+        ) from e
+    if "format" not in payload:
+        # plain state dict written before snapshots were introduced
+        payload = {"format": SNAPSHOT_FORMAT, "seq": 0, "state": payload}
+    if payload["format"] > SNAPSHOT_FORMAT:
+        raise RuntimeError(
+            f"{path} has snapshot format {payload['format']}, "
+            f"this version only reads up to {SNAPSHOT_FORMAT}"
+        )
+    if payload.get("layout") == "rows":
+        state = state_from_rows(payload["state"])
+    else:
+        state = state_from_dict(payload["state"])
+    # snapshots written before the cache kept the live order could list
+    # tables out of id order
+    state["tables"] = dict(sorted(state["tables"].items()))
+    if payload["format"] < 3 and state["totals"] is not None:
+        # kept while older tables still counted as paying nothing
+        state["totals"] = None
+    return state, payload["seq"]
+
+
+_ID_FIELDS = ("uid", "promoter_id", "table_id")
+
+
+def _migrate_record(rec: Dict[str, Any]) -> Dict[str, Any]:
+    # delta records written before format 2 carried string user ids
+    for key in _ID_FIELDS:
+        if isinstance(rec.get(key), str):
+            rec[key] = int(rec[key])
+    if rec["op"] == "table_created" and rec.get("prize") is None:
+        rec["prize"], rec["house_cut"] = LEGACY_PRIZE, LEGACY_HOUSE_CUT
+    return rec
+
+
+# ---------- MUTATIONS ----------
+# Every change to the state is a small record {"op": ..., **fields}. The same
+# function applies it live and when the write-ahead log is replayed on startup,
+# so the two paths can never drift apart.
+
+Mutation = Callable[[Dict[str, Any], Dict[str, Any]], None]
+MUTATIONS: Dict[str, Mutation] = {}
+
+
+def iso_week(ts: float) -> str:
+    return time.strftime("%G-W%V", time.gmtime(ts))
+
+
+def _count_table(totals: Totals, table: Table, sign: int = 1) -> None:
+    """Add ``table`` to the totals as it is now, or take it out with sign -1.
+
+    A table changing status is taken out, changed and added back; the full
+    recompute adds every table once. Both backends go through here.
+    """
+    if table.status == "waiting":
+        totals.waiting += sign
+    elif table.status == "running":
+        totals.running += sign
+        totals.prize_liability += sign * (table.prize or 0)
+    elif table.status == "cancelled":
+        totals.cancelled += sign
+    else:
+        totals.finished += sign
+        totals.prizes += sign * (table.prize or 0)
+        cut = sign * (table.house_cut or 0)
+        totals.house_cut += cut
+        if table.finished_at is not None:
+            week = iso_week(table.finished_at)
+            by_week = totals.house_cut_by_week
+            by_week[week] = by_week.get(week, 0) + cut
+
+
+def mutation(name: str) -> Callable[[Mutation], Mutation]:
+    def register(fn: Mutation) -> Mutation:
+        MUTATIONS[name] = fn
+        return fn
+    return register
+
+
+def _evict_username(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    # the player who held the username before; see StateStore._stale_holder
+    if "evicted" in rec:
+        state["players"][rec["evicted"]].username = None
+
+
+@mutation("player_created")
+def _player_created(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    _evict_username(state, rec)
+    state["players"][rec["uid"]] = Player(rec["uid"], rec["username"], rec["first_name"])
+
+
+@mutation("player_renamed")
+def _player_renamed(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    _evict_username(state, rec)
+    player = state["players"][rec["uid"]]
+    player.username = rec["username"]
+    player.first_name = rec["first_name"]
+
+
+@mutation("promoter_created")
+def _promoter_created(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    state["promoters"][rec["uid"]] = Promoter(
+        rec["uid"], rec["username"], rec["first_name"], f"promo_{rec['uid']}"
+    )
+
+
+@mutation("promoter_renamed")
+def _promoter_renamed(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    promoter = state["promoters"][rec["uid"]]
+    promoter.username = rec["username"]
+    promoter.first_name = rec["first_name"]
+
+
+@mutation("player_referred")
+def _player_referred(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    state["players"][rec["uid"]].referred_by = rec["promoter_id"]
+    state["promoters"][rec["promoter_id"]].referred_players += 1
+
+
+@mutation("table_created")
+def _table_created(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    table_id = rec["table_id"]
+    state["next_table_id"] = table_id + 1
+    table = state["tables"][table_id] = Table(
+        table_id,
+        rec["buy_in"],
+        prize=rec.get("prize"),
+        house_cut=rec.get("house_cut"),
+        pool=rec.get("pool"),
+        size=rec.get("size"),
+    )
+    _count_table(state["totals"], table)
+
+
+@mutation("table_joined")
+def _table_joined(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    state["tables"][rec["table_id"]].players.append(rec["uid"])
+    state["players"][rec["uid"]].joined_tables += 1
+
+
+@mutation("table_started")
+def _table_started(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    table = state["tables"][rec["table_id"]]
+    _count_table(state["totals"], table, -1)
+    table.status = "running"
+    _count_table(state["totals"], table)
+
+
+@mutation("winner_set")
+def _winner_set(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    table = state["tables"][rec["table_id"]]
+    _count_table(state["totals"], table, -1)
+    table.status = "finished"
+    table.winner_id = rec["uid"]
+    table.finished_at = rec.get("at")  # absent in records from older versions
+    _count_table(state["totals"], table)
+    state["players"][rec["uid"]].wins += 1
+
+
+@mutation("table_cancelled")
+def _table_cancelled(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    table = state["tables"][rec["table_id"]]
+    _count_table(state["totals"], table, -1)
+    table.status = "cancelled"
+    table.finished_at = rec["at"]
+    _count_table(state["totals"], table)
+
+
+@mutation("payout_accrued")
+def _payout_accrued(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    state["promoters"][rec["promoter_id"]].pending_payout += rec["amount"]
+    state["totals"].pending_payouts += rec["amount"]
+
+
+@mutation("tables_archived")
+def _tables_archived(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    # the tables themselves were appended to the archive before this record
+    for table_id in rec["table_ids"]:
+        del state["tables"][table_id]
+    state["archive_size"] = rec["archive_size"]
+
+
+@mutation("entry_recorded")
+def _entry_recorded(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    # the entry itself was appended to the ledger before this record
+    state["ledger_entries"] = rec["entry_id"]
+    state["ledger_size"] = rec["ledger_size"]
+
+
+@mutation("payouts_settled")
+def _payouts_settled(state: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    state["settlements"] = rec["batch"]
+    totals = state["totals"]
+    for promoter_id, amount in rec["payouts"]:
+        promoter = state["promoters"][promoter_id]
+        promoter.pending_payout -= amount
+        promoter.total_paid += amount
+        totals.pending_payouts -= amount
+        totals.paid_out += amount
+
+
+logger = logging.getLogger(__name__)
+
+# ---------- REPOSITORY API ----------
+
+CLOSED_STATUSES = ("finished", "cancelled")  # what archive_tables() moves
+PROMOTER_ORDERS = ("id", "balance")  # "balance": largest pending payout first
+
+
+def promoter_key(by: str, promoter: Promoter) -> tuple:
+    """Sort key of iter_promoters(by); also its ``after`` cursor."""
+    if by == "balance":
+        return (-promoter.pending_payout, promoter.id)
+    if by == "id":
+        return (promoter.id,)
+    raise ValueError(f"Unknown promoter order: {by}")
+
+
+def _settle(waiters: List[asyncio.Future], error: Optional[BaseException]) -> None:
+    for fut in waiters:
+        if fut.done():
+            continue
+        if error is None:
+            fut.set_result(None)
+        else:
+            fut.set_exception(error)
+
+
+class Storage:
+    """What the handlers are allowed to know about persistence.
+
+    Players and promoters are keyed by the Telegram user id, tables by their
+    own id; both are ints. Returned records are models (see models.py) and must
+    be treated as read-only; all changes go through the mutating methods,
+    which return the updated record.
+
+    Writes are group-committed: a mutation is applied in memory right away
+    and only marks the store dirty. Dirty writes are made durable together,
+    at most ``flush_interval`` seconds after the first of them or as soon as
+    ``flush_max_pending`` have piled up. A handler that must not acknowledge
+    something before it is on disk awaits commit(). Writes made inside
+    batch() are only counted once it ends, so no flush falls between them.
+
+    Finished tables are moved out of the live state by archive_tables() once
+    they are old enough. table(), waiting_table() and iter_tables() only see
+    live tables; the archive is append-only and read a page at a time.
+
+    totals() are running sums over everything, archived tables included,
+    updated by the same calls that change what they sum.
+
+    The calls that move money (join_table, finish_table, accrue_payout,
+    settle_payouts) also append ledger entries, in the same batch. The
+    ledger is never rewritten; iter_ledger() streams it back.
+    """
+
+    flush_interval = 0.1
+    flush_max_pending = 64
+
+    def open(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        raise NotImplementedError
+
+    def snapshot(self) -> bool:
+        """Compact whatever the backend logs between checkpoints."""
+        raise NotImplementedError
+
+    def _sync(self) -> Optional[Future]:
+        """Make every write issued so far durable.
+
+        Backends that write on a background thread return the Future of that
+        write instead of blocking; None means the writes already are durable.
+        """
+        raise NotImplementedError
+
+    # ---------- group commit ----------
+
+    _pending = 0
+    _batch_depth = 0
+    _flush_handle: Optional[asyncio.TimerHandle] = None
+    _waiters: List[asyncio.Future] = []
+    _written: Optional[Future] = None  # latest background write, if any
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Make every write inside one flush unit: durable all together or
+        not at all. Nests; must not span an await."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._pending:
+                self._schedule_flush()
+
+    def _mutated(self) -> None:
+        self._pending += 1
+        if not self._batch_depth:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._pending >= self.flush_max_pending:
+            self.flush()
+            return
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no event loop (scripts, maintenance): write through
+                self.drain()
+                return
+            self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self) -> None:
+        """Hand every dirty write to the disk, without waiting for it."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        written = None
+        if self._pending:
+            written = self._sync()
+            self._pending = 0
+        waiters, self._waiters = self._waiters, []
+        if written is None:
+            _settle(waiters, None)
+        elif waiters:
+            loop = waiters[0].get_loop()
+            written.add_done_callback(
+                lambda f: loop.call_soon_threadsafe(_settle, waiters, f.exception())
+            )
+
+    def drain(self) -> None:
+        """Flush and block until everything written so far is durable."""
+        self.flush()
+        if self._written is not None:
+            self._written.result()
+
+    async def commit(self) -> None:
+        """Wait until every mutation made so far is durable."""
+        if self._pending:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters = self._waiters + [fut]
+            await fut
+        elif self._written is not None:
+            # flushed already: the background write may still be running, or
+            # have failed with nobody waiting on it
+            await asyncio.wrap_future(self._written)
+
+    # players / promoters
+
+    def player(self, uid: int) -> Optional[Player]:
+        raise NotImplementedError
+
+    def create_player(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Player:
+        raise NotImplementedError
+
+    def rename_player(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Player:
+        raise NotImplementedError
+
+    def player_by_username(self, username: str) -> Optional[int]:
+        """Case-insensitive username lookup, returns the user id."""
+        raise NotImplementedError
+
+    def iter_players(self) -> Iterator[Player]:
+        raise NotImplementedError
+
+    def promoter(self, uid: int) -> Optional[Promoter]:
+        raise NotImplementedError
+
+    def create_promoter(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Promoter:
+        raise NotImplementedError
+
+    def rename_promoter(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Promoter:
+        raise NotImplementedError
+
+    def refer_player(self, uid: int, promoter_id: int) -> None:
+        raise NotImplementedError
+
+    def accrue_payout(
+        self, promoter_id: int, amount: float, table_id: Optional[int] = None
+    ) -> None:
+        raise NotImplementedError
+
+    def iter_promoters(
+        self, by: str = "id", after: Optional[tuple] = None
+    ) -> Iterator[Promoter]:
+        """Promoters in promoter_key(by) order, from just past ``after``."""
+        raise NotImplementedError
+
+    # tables
+
+    def table(self, table_id: int) -> Optional[Table]:
+        raise NotImplementedError
+
+    def waiting_table(self, pool: Optional[str], size: int) -> Optional[Table]:
+        """Oldest waiting table of ``pool`` with a free seat.
+
+        Each pool is queued on its own, so this does not depend on how many
+        tables other pools have waiting. ``size`` is the seat count of tables
+        that do not record their own.
+        """
+        raise NotImplementedError
+
+    def create_table(
+        self, buy_in: int, prize: int, house_cut: int, pool: str, size: int
+    ) -> Table:
+        raise NotImplementedError
+
+    def join_table(self, table_id: int, uid: int) -> Table:
+        raise NotImplementedError
+
+    def start_table(self, table_id: int) -> Table:
+        raise NotImplementedError
+
+    def finish_table(self, table_id: int, winner_uid: int) -> Table:
+        raise NotImplementedError
+
+    def cancel_table(self, table_id: int) -> Table:
+        """Close a table without a winner and refund everyone's buy-in."""
+        raise NotImplementedError
+
+    def iter_tables(
+        self, status: Optional[str] = None, after: int = 0
+    ) -> Iterator[Table]:
+        """Live tables (not yet archived) by id, from just past ``after``,
+        optionally only those with this status."""
+        raise NotImplementedError
+
+    def archive_tables(self, finished_before: float) -> int:
+        """Archive tables finished or cancelled before this unix time;
+        returns how many."""
+        raise NotImplementedError
+
+    def archived_count(self) -> int:
+        raise NotImplementedError
+
+    def archived_tables(self, offset: int, limit: int) -> List[Table]:
+        """A page of archived tables, most recently archived first."""
+        raise NotImplementedError
+
+    # totals
+
+    def totals(self) -> Totals:
+        """Running totals, without scanning anything."""
+        raise NotImplementedError
+
+    def recompute_totals(self, page_size: int = 1000) -> Totals:
+        """The totals by a full scan of every promoter and table, archived
+        ones included; totals() must agree, up to float rounding."""
+        totals = Totals()
+        for promoter in self.iter_promoters():
+            totals.pending_payouts += promoter.pending_payout
+            totals.paid_out += promoter.total_paid
+        for table in self.iter_tables():
+            _count_table(totals, table)
+        offset = 0
+        while True:
+            page = self.archived_tables(offset, page_size)
+            if not page:
+                break
+            for table in page:
+                _count_table(totals, table)
+            offset += len(page)
+        return totals
+
+    # ledger
+
+    def iter_ledger(self, after: int = 0) -> Iterator[LedgerEntry]:
+        """Ledger entries in id order, from just past entry ``after``."""
+        raise NotImplementedError
+
+    def settle_payouts(self) -> Dict[int, LedgerEntry]:
+        """Pay out every pending promoter balance as one settlement.
+
+        Returns promoter id -> payout entry, largest first; empty if no
+        balance was pending.
+        """
+        pending = list(
+            itertools.takewhile(
+                lambda p: p.pending_payout > 0, self.iter_promoters("balance")
+            )
+        )
+        if not pending:
+            return {}
+        batch = self._last_settlement() + 1
+        with self.batch():
+            payouts = {
+                p.id: self._record(
+                    "payout",
+                    PAYOUTS,
+                    promoter_account(p.id),
+                    p.pending_payout,
+                    batch=batch,
+                )
+                for p in pending
+            }
+            self._mark_paid(batch, payouts)
+        return payouts
+
+    def _record(
+        self,
+        kind: str,
+        debit: str,
+        credit: str,
+        amount: float,
+        table_id: Optional[int] = None,
+        batch: Optional[int] = None,
+    ) -> LedgerEntry:
+        """Append one entry, as part of the surrounding mutation."""
+        raise NotImplementedError
+
+    def _last_settlement(self) -> int:
+        raise NotImplementedError
+
+    def _mark_paid(self, batch: int, payouts: Dict[int, LedgerEntry]) -> None:
+        """Move the paid amounts from pending to paid on the promoters."""
+        raise NotImplementedError
+
+    def _record_refunds(self, table: Table) -> None:
+        pot = table_account(table.id)
+        for uid in table.players:
+            self._record("refund", player_account(uid), pot, table.buy_in, table.id)
+
+    def _record_finish(self, table: Table) -> None:
+        pot = table_account(table.id)
+        if table.prize:
+            winner = player_account(table.winner_id)
+            self._record("prize", winner, pot, table.prize, table.id)
+        if table.house_cut:
+            self._record("house_cut", HOUSE, pot, table.house_cut, table.id)
+
+    def _record_opening_balances(self) -> None:
+        # balances accrued before the ledger existed, carried over once
+        if next(self.iter_ledger(), None) is not None:
+            return
+        with self.batch():
+            for promoter in self.iter_promoters():
+                if promoter.pending_payout:
+                    self._record(
+                        "opening",
+                        promoter_account(promoter.id),
+                        HOUSE,
+                        promoter.pending_payout,
+                    )
+
+
+# ---------- JSON STATE STORE ----------
+
+def _fsync_dir(path: Path) -> None:
+    # make a rename inside the directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StateStore(Storage):
+    """Keeps the bot state resident in memory.
+
+    The snapshot file holds the last snapshot, tagged with the sequence number
+    of the last mutation folded into it, in whichever encoding ``serializer``
+    names (see serialization.py); loading detects the encoding by itself.
+    Every mutation since then is appended to the delta log (state.wal) as one
+    compact JSON line, so a command costs O(1) disk I/O no matter how much
+    history has piled up. snapshot() folds the delta into a fresh snapshot;
+    startup is a snapshot load plus a replay of the short delta written
+    after it.
+
+    Disk writes run on a single writer thread, in the order they were
+    issued, so neither fsync nor snapshot encoding blocks the event loop.
+    The loop only formats delta records and captures a copy of the state for
+    snapshots; commit() waits for the writer. Once a write fails, every later
+    one fails too, since the files could no longer be trusted to replay.
+
+    Lookups that would otherwise scan every table ever created are served
+    from in-memory indexes. They are derived data: never persisted, rebuilt
+    from the loaded state on open and kept current by the mutating methods.
+
+    Archived tables live in their own append-only JSON lines file and are not
+    part of the snapshot at all. The state records how many bytes of that
+    file it accounts for, so an archive pass interrupted before its delta
+    record is durable is cut off again on open. The ledger is kept the same
+    way; its entries are appended on each flush, ahead of the delta records
+    that account for them.
+    """
+
+    def __init__(
+        self,
+        state_file: Path,
+        wal_file: Path,
+        archive_file: Path,
+        serializer: Optional[Serializer] = None,
+        ledger_file: Optional[Path] = None,
+    ):
+        self.state_file = state_file
+        self.wal_file = wal_file
+        self.archive_file = archive_file
+        self.ledger_file = ledger_file or wal_file.with_name("ledger.jsonl")
+        self.serializer = serializer or get_serializer("json")
+        self.state: Dict[str, Any] = empty_state()
+        self.seq = 0            # last mutation applied
+        self.snapshot_seq = 0   # last mutation contained in the snapshot
+        self._wal = None
+        # pool -> its waiting table ids, oldest first (dict as an ordered set)
+        self._waiting: Dict[Optional[str], Dict[int, None]] = {}
+        # casefolded username -> user id
+        self._by_username: Dict[str, int] = {}
+        # order -> every promoter's promoter_key(order), sorted
+        self._promoter_keys: Dict[str, List[tuple]] = {
+            by: [] for by in PROMOTER_ORDERS
+        }
+        # byte offset of every archived table, in archive order
+        self._archive_offsets: List[int] = []
+        self._archive_written: Optional[Future] = None
+        # delta records formatted since the last flush, not yet handed over
+        self._lines: List[str] = []
+        # likewise for ledger entries
+        self._entries: List[bytes] = []
+        self._ledger = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._write_error: Optional[BaseException] = None
+        self._snapshot_cache = SnapshotCache(self.serializer.rows)
+
+    def open(self) -> None:
+        self.state_file.parent.mkdir(exist_ok=True)
+        self.state, self.seq = self._load_snapshot()
+        self.snapshot_seq = self.seq
+        stale_totals = self.state["totals"] is None
+        if stale_totals:
+            self.state["totals"] = Totals()  # replay adds to it; replaced below
+        self._replay_wal()
+        self._rebuild_indexes()
+        self._snapshot_cache = SnapshotCache(self.serializer.rows)
+        self._snapshot_cache.touch_all(self.state)
+        self._open_archive()
+        if stale_totals:
+            self.state["totals"] = self.recompute_totals()
+        self._ledger = self._open_appendix(self.ledger_file, self.state["ledger_size"])
+        self._wal = self.wal_file.open("a", encoding="utf-8")
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="state-writer")
+        self._record_opening_balances()
+
+    def _rebuild_indexes(self) -> None:
+        self._waiting = {}
+        for table in self.state["tables"].values():  # in id order
+            if table.status == "waiting":
+                self._waiting.setdefault(table.pool, {})[table.id] = None
+        self._by_username = {
+            p.username.casefold(): uid
+            for uid, p in self.state["players"].items()
+            if p.username
+        }
+        self._promoter_keys = {
+            by: sorted(promoter_key(by, p) for p in self.state["promoters"].values())
+            for by in PROMOTER_ORDERS
+        }
+
+    def _open_archive(self) -> None:
+        with self._open_appendix(self.archive_file, self.state["archive_size"]) as f:
+            f.seek(0)
+            offsets, pos = [], 0
+            for line in f:
+                offsets.append(pos)
+                pos += len(line)
+        self._archive_offsets = offsets
+
+    @staticmethod
+    def _open_appendix(path: Path, size: int):
+        """Open an append-only file cut back to the ``size`` the state knows."""
+        path.touch()
+        f = path.open("r+b")
+        if f.seek(0, os.SEEK_END) < size:
+            f.close()
+            raise RuntimeError(
+                f"{path} is shorter than the state expects; refusing to start"
+            )
+        f.truncate(size)
+        f.seek(size)
+        return f
+
+    def close(self) -> None:
+        if self._wal is None:
+            return
+        self.flush()
+        self.snapshot()
+        self._writer.shutdown(wait=True)
+        self._writer = None
+        self._wal.close()
+        self._wal = None
+        self._ledger.close()
+        self._ledger = None
+
+    def apply(self, op: str, **fields: Any) -> None:
+        rec = {"op": op, **fields}
+        MUTATIONS[op](self.state, rec)
+        self.seq += 1
+        rec["seq"] = self.seq
+        self._lines.append(json.dumps(rec, separators=(",", ":")) + "\n")
+        self._snapshot_cache.touch(rec)
+        self._mutated()
+
+    def _sync(self) -> Future:
+        entries, self._entries = self._entries, []
+        if entries:
+            self._submit(self._append_ledger, b"".join(entries))
+        lines, self._lines = self._lines, []
+        return self._submit(self._append_wal, "".join(lines))
+
+    def _submit(self, fn: Callable[..., None], *args: Any) -> Future:
+        self._written = self._writer.submit(self._write, fn, *args)
+        return self._written
+
+    def _write(self, fn: Callable[..., None], *args: Any) -> None:
+        # runs on the writer thread
+        if self._write_error is not None:
+            raise RuntimeError("an earlier state write failed") from self._write_error
+        try:
+            fn(*args)
+        except BaseException as e:
+            self._write_error = e
+            logger.exception("state write failed; no further writes will be made")
+            raise
+
+    def _append_wal(self, data: str) -> None:
+        self._wal.write(data)
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+
+    def _append_ledger(self, data: bytes) -> None:
+        self._ledger.write(data)
+        self._ledger.flush()
+        os.fsync(self._ledger.fileno())
+
+    @property
+    def delta_size(self) -> int:
+        return self.seq - self.snapshot_seq
+
+    def snapshot(self) -> bool:
+        """Fold the delta log into a fresh snapshot.
+
+        The snapshot is written to a temp file, fsynced and renamed over
+        the old one, so a crash leaves either the old or the new snapshot on
+        disk, never a torn one. Returns False if there was nothing to fold.
+        """
+        if self.delta_size == 0:
+            return False
+        # the payload shares nothing mutable with the live state, so the
+        # writer can encode it while handlers keep going
+        payload = self._snapshot_cache.payload(self.state, self.seq)
+        self.snapshot_seq = self.seq
+        if self._writer is None:
+            self._write_snapshot(payload)
+        else:
+            # queued behind the delta records it contains
+            self.flush()
+            self._submit(self._write_snapshot, payload)
+        return True
+
+    def _write_snapshot(self, payload: Dict[str, Any]) -> None:
+        tmp = self.state_file.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            f.write(encode(self.serializer, payload))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.state_file)
+        _fsync_dir(self.state_file.parent)
+        # Records up to the snapshot's seq are skipped on replay, so a crash
+        # before the truncate below only costs a slightly longer startup.
+        # Later records are still queued behind this write.
+        if self._wal is not None:
+            self._wal.truncate(0)
+            self._wal.seek(0)
+
+    def _load_snapshot(self) -> Tuple[Dict[str, Any], int]:
+        if not self.state_file.exists():
+            return empty_state(), 0
+        return read_snapshot(self.state_file)
+
+    def _replay_wal(self) -> None:
+        if not self.wal_file.exists():
+            return
+        good = 0
+        with self.wal_file.open("r", encoding="utf-8") as f:
+            for line in iter(f.readline, ""):
+                if not line.endswith("\n"):
+                    # torn final record from a crash mid-append; nothing
+                    # after it was ever acknowledged
+                    break
+                rec = json.loads(line)
+                good = f.tell()
+                if rec["seq"] <= self.seq:
+                    continue  # already folded into the snapshot
+                MUTATIONS[rec["op"]](self.state, _migrate_record(rec))
+                self.seq = rec["seq"]
+        with self.wal_file.open("r+", encoding="utf-8") as f:
+            f.truncate(good)
+
+    # ---------- repository API ----------
+
+    def player(self, uid: int) -> Optional[Player]:
+        return self.state["players"].get(uid)
+
+    def create_player(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Player:
+        self.apply(
+            "player_created",
+            uid=uid,
+            username=username,
+            first_name=first_name,
+            **self._stale_holder(uid, username),
+        )
+        if username:
+            self._by_username[username.casefold()] = uid
+        return self.state["players"][uid]
+
+    def rename_player(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Player:
+        old = self.state["players"][uid].username
+        if old and self._by_username.get(old.casefold()) == uid:
+            del self._by_username[old.casefold()]
+        self.apply(
+            "player_renamed",
+            uid=uid,
+            username=username,
+            first_name=first_name,
+            **self._stale_holder(uid, username),
+        )
+        if username:
+            self._by_username[username.casefold()] = uid
+        return self.state["players"][uid]
+
+    def _stale_holder(self, uid: int, username: Optional[str]) -> Dict[str, int]:
+        # Telegram lets a freed username be taken by someone else. The newest
+        # holder wins and the older record loses it, in the delta record
+        # itself, so a replay rebuilds the same index.
+        holder = self._by_username.get(username.casefold()) if username else None
+        return {} if holder is None or holder == uid else {"evicted": holder}
+
+    def player_by_username(self, username: str) -> Optional[int]:
+        return self._by_username.get(username.casefold())
+
+    def iter_players(self) -> Iterator[Player]:
+        return iter(self.state["players"].values())
+
+    def promoter(self, uid: int) -> Optional[Promoter]:
+        return self.state["promoters"].get(uid)
+
+    def create_promoter(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Promoter:
+        self.apply("promoter_created", uid=uid, username=username, first_name=first_name)
+        promoter = self.state["promoters"][uid]
+        for by, keys in self._promoter_keys.items():
+            bisect.insort(keys, promoter_key(by, promoter))
+        return promoter
+
+    def rename_promoter(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Promoter:
+        self.apply("promoter_renamed", uid=uid, username=username, first_name=first_name)
+        return self.state["promoters"][uid]
+
+    def refer_player(self, uid: int, promoter_id: int) -> None:
+        self.apply("player_referred", uid=uid, promoter_id=promoter_id)
+
+    def accrue_payout(
+        self, promoter_id: int, amount: float, table_id: Optional[int] = None
+    ) -> None:
+        old_key = promoter_key("balance", self.state["promoters"][promoter_id])
+        with self.batch():
+            self.apply("payout_accrued", promoter_id=promoter_id, amount=amount)
+            self._rekey_balance(promoter_id, old_key)
+            self._record(
+                "promo_bonus", promoter_account(promoter_id), HOUSE, amount, table_id
+            )
+
+    def _rekey_balance(self, promoter_id: int, old_key: tuple) -> None:
+        keys = self._promoter_keys["balance"]
+        del keys[bisect.bisect_left(keys, old_key)]
+        promoter = self.state["promoters"][promoter_id]
+        bisect.insort(keys, promoter_key("balance", promoter))
+
+    def iter_promoters(
+        self, by: str = "id", after: Optional[tuple] = None
+    ) -> Iterator[Promoter]:
+        # a binary search for the cursor, then one lookup per promoter read
+        if by not in self._promoter_keys:
+            raise ValueError(f"Unknown promoter order: {by}")
+        keys = self._promoter_keys[by]
+        i = 0 if after is None else bisect.bisect_right(keys, after)
+        promoters = self.state["promoters"]
+        while i < len(keys):
+            yield promoters[keys[i][-1]]
+            i += 1
+
+    def table(self, table_id: int) -> Optional[Table]:
+        return self.state["tables"].get(table_id)
+
+    def waiting_table(self, pool: Optional[str], size: int) -> Optional[Table]:
+        # only tables still filling up are indexed, so this is O(1) in
+        # practice no matter how many finished tables there are
+        for table_id in self._waiting.get(pool, ()):
+            table = self.state["tables"][table_id]
+            if len(table.players) < (table.size or size):
+                return table
+        return None
+
+    def create_table(
+        self, buy_in: int, prize: int, house_cut: int, pool: str, size: int
+    ) -> Table:
+        table_id = self.state["next_table_id"]
+        self.apply(
+            "table_created",
+            table_id=table_id,
+            buy_in=buy_in,
+            prize=prize,
+            house_cut=house_cut,
+            pool=pool,
+            size=size,
+        )
+        self._waiting.setdefault(pool, {})[table_id] = None
+        return self.state["tables"][table_id]
+
+    def _unwait(self, table: Table) -> None:
+        queue = self._waiting.get(table.pool)
+        if queue is not None:
+            queue.pop(table.id, None)
+
+    def join_table(self, table_id: int, uid: int) -> Table:
+        with self.batch():
+            self.apply("table_joined", table_id=table_id, uid=uid)
+            table = self.state["tables"][table_id]
+            self._record(
+                "buy_in",
+                table_account(table_id),
+                player_account(uid),
+                table.buy_in,
+                table_id,
+            )
+        return table
+
+    def start_table(self, table_id: int) -> Table:
+        self.apply("table_started", table_id=table_id)
+        table = self.state["tables"][table_id]
+        self._unwait(table)
+        return table
+
+    def finish_table(self, table_id: int, winner_uid: int) -> Table:
+        with self.batch():
+            self.apply("winner_set", table_id=table_id, uid=winner_uid, at=time.time())
+            table = self.state["tables"][table_id]
+            self._unwait(table)
+            self._record_finish(table)
+        return table
+
+    def cancel_table(self, table_id: int) -> Table:
+        with self.batch():
+            self.apply("table_cancelled", table_id=table_id, at=time.time())
+            table = self.state["tables"][table_id]
+            self._unwait(table)
+            self._record_refunds(table)
+        return table
+
+    def iter_tables(
+        self, status: Optional[str] = None, after: int = 0
+    ) -> Iterator[Table]:
+        # tables are created, and so kept, in id order
+        for table in self.state["tables"].values():
+            if table.id > after and (status is None or table.status == status):
+                yield table
+
+    def archive_tables(self, finished_before: float) -> int:
+        table_ids = sorted(
+            t.id
+            for t in self.state["tables"].values()
+            if t.status in CLOSED_STATUSES and (t.finished_at or 0) <= finished_before
+        )
+        if not table_ids:
+            return 0
+        lines, offsets = [], []
+        pos = self.state["archive_size"]
+        for table_id in table_ids:
+            line = json.dumps(
+                self.state["tables"][table_id].to_dict(), separators=(",", ":")
+            ).encode("utf-8") + b"\n"
+            lines.append(line)
+            offsets.append(pos)
+            pos += len(line)
+        # the writer makes the archive copy durable before it gets to the
+        # delta record that drops the live one
+        self._archive_written = self._submit(self._append_archive, b"".join(lines))
+        self.apply("tables_archived", table_ids=table_ids, archive_size=pos)
+        self._archive_offsets.extend(offsets)
+        return len(table_ids)
+
+    def _append_archive(self, data: bytes) -> None:
+        with self.archive_file.open("ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def archived_count(self) -> int:
+        return len(self._archive_offsets)
+
+    def archived_tables(self, offset: int, limit: int) -> List[Table]:
+        end = max(len(self._archive_offsets) - offset, 0)
+        page = self._archive_offsets[max(end - limit, 0):end]
+        if self._archive_written is not None:
+            self._archive_written.result()  # only blocks right after a pass
+        tables = []
+        with self.archive_file.open("rb") as f:
+            for pos in reversed(page):
+                f.seek(pos)
+                table = Table.from_dict(json.loads(f.readline()))
+                tables.append(_backfill_terms(table))
+        return tables
+
+    def totals(self) -> Totals:
+        return self.state["totals"]
+
+    # ---------- ledger ----------
+
+    def iter_ledger(self, after: int = 0) -> Iterator[LedgerEntry]:
+        self.drain()  # entries are only readable once written
+        with self.ledger_file.open("rb") as f:
+            for line in f:
+                entry = LedgerEntry.from_dict(json.loads(line))
+                if entry.id > after:
+                    yield entry
+
+    def _record(
+        self,
+        kind: str,
+        debit: str,
+        credit: str,
+        amount: float,
+        table_id: Optional[int] = None,
+        batch: Optional[int] = None,
+    ) -> LedgerEntry:
+        entry = LedgerEntry(
+            self.state["ledger_entries"] + 1,
+            time.time(),
+            kind,
+            debit,
+            credit,
+            amount,
+            table_id,
+            batch,
+        )
+        line = json.dumps(entry.to_dict(), separators=(",", ":")).encode("utf-8")
+        self._entries.append(line + b"\n")
+        self.apply(
+            "entry_recorded",
+            entry_id=entry.id,
+            ledger_size=self.state["ledger_size"] + len(line) + 1,
+        )
+        return entry
+
+    def _last_settlement(self) -> int:
+        return self.state["settlements"]
+
+    def _mark_paid(self, batch: int, payouts: Dict[int, LedgerEntry]) -> None:
+        old_keys = {
+            pid: promoter_key("balance", self.state["promoters"][pid])
+            for pid in payouts
+        }
+        self.apply(
+            "payouts_settled",
+            batch=batch,
+            payouts=[[pid, entry.amount] for pid, entry in payouts.items()],
+        )
+        for pid, old_key in old_keys.items():
+            self._rekey_balance(pid, old_key)
+
+
+# ---------- SQLITE STORE ----------
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    id            INTEGER PRIMARY KEY,
+    username      TEXT,
+    username_key  TEXT,              -- casefolded username for lookups
+    first_name    TEXT,
+    joined_tables INTEGER NOT NULL DEFAULT 0,
+    wins          INTEGER NOT NULL DEFAULT 0,
+    referred_by   INTEGER,
+    promo_code    TEXT
+);
+CREATE INDEX IF NOT EXISTS players_username_key ON players (username_key);
+CREATE INDEX IF NOT EXISTS players_referred_by ON players (referred_by);
+
+CREATE TABLE IF NOT EXISTS promoters (
+    id               INTEGER PRIMARY KEY,
+    username         TEXT,
+    first_name       TEXT,
+    promo_code       TEXT NOT NULL,
+    referred_players INTEGER NOT NULL DEFAULT 0,
+    pending_payout   REAL NOT NULL DEFAULT 0,
+    total_paid       REAL NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS promoters_promo_code ON promoters (promo_code);
+CREATE INDEX IF NOT EXISTS promoters_balance ON promoters (pending_payout DESC, id);
+
+CREATE TABLE IF NOT EXISTS tables (
+    id          INTEGER PRIMARY KEY,
+    status      TEXT NOT NULL,       -- waiting | running | finished | cancelled
+    buy_in      INTEGER NOT NULL,
+    winner_id   INTEGER,
+    finished_at REAL,
+    prize       INTEGER,
+    house_cut   INTEGER,
+    pool        TEXT,
+    size        INTEGER
+);
+CREATE INDEX IF NOT EXISTS tables_status ON tables (status, id);
+
+CREATE TABLE IF NOT EXISTS seats (
+    table_id  INTEGER NOT NULL REFERENCES tables (id),
+    seat      INTEGER NOT NULL,
+    player_id INTEGER NOT NULL REFERENCES players (id),
+    PRIMARY KEY (table_id, seat)
+);
+CREATE INDEX IF NOT EXISTS seats_player ON seats (player_id);
+
+CREATE TABLE IF NOT EXISTS tables_archive (
+    seq         INTEGER PRIMARY KEY, -- archive order
+    id          INTEGER NOT NULL UNIQUE,
+    buy_in      INTEGER NOT NULL,
+    winner_id   INTEGER,
+    finished_at REAL,
+    players     TEXT NOT NULL,       -- comma-separated player ids, seat order
+    prize       INTEGER,
+    house_cut   INTEGER,
+    status      TEXT NOT NULL DEFAULT 'finished', -- finished | cancelled
+    pool        TEXT,
+    size        INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS totals (
+    name  TEXT PRIMARY KEY,          -- a Totals field, or house_cut:<ISO week>
+    value NUMERIC NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS ledger (
+    id       INTEGER PRIMARY KEY,    -- append order
+    at       REAL NOT NULL,
+    kind     TEXT NOT NULL,
+    debit    TEXT NOT NULL,
+    credit   TEXT NOT NULL,
+    amount   REAL NOT NULL,
+    table_id INTEGER,
+    batch    INTEGER                 -- settlement number, on payouts
+);
+CREATE INDEX IF NOT EXISTS ledger_batch ON ledger (batch) WHERE batch IS NOT NULL;
+"""
+
+# columns added after the first release: (table, column, type)
+SQLITE_MIGRATIONS = (
+    ("tables", "finished_at", "REAL"),
+    ("tables", "prize", "INTEGER"),
+    ("tables", "house_cut", "INTEGER"),
+    ("tables_archive", "prize", "INTEGER"),
+    ("tables_archive", "house_cut", "INTEGER"),
+    ("tables_archive", "status", "TEXT NOT NULL DEFAULT 'finished'"),
+    ("tables", "pool", "TEXT"),
+    ("tables", "size", "INTEGER"),
+    ("tables_archive", "pool", "TEXT"),
+    ("tables_archive", "size", "INTEGER"),
+)
+
+# indexes on columns the migrations above may have to add first
+SQLITE_LATE_INDEXES = """
+CREATE INDEX IF NOT EXISTS tables_pool ON tables (pool, status, id);
+"""
+
+
+class SqliteStore(Storage):
+    """Normalized SQLite backend behind the same repository API.
+
+    One connection is shared by every handler and the database runs in WAL
+    journal mode, so lookups stay index-bound as history grows and a write
+    is a single short transaction. Archived tables move to tables_archive,
+    with their seats folded into a single column. Ledger rows are only ever
+    inserted.
+    """
+
+    def __init__(self, db_file: Path):
+        self.db_file = db_file
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def open(self) -> None:
+        self.db_file.parent.mkdir(exist_ok=True)
+        self.conn = sqlite3.connect(self.db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL would skip the fsync at commit in WAL mode, and a commit()
+        # that returned could still be lost on power failure
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SQLITE_SCHEMA)
+        for table, column, decl in SQLITE_MIGRATIONS:
+            columns = {
+                row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")
+            }
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        self.conn.executescript(SQLITE_LATE_INDEXES)
+        backfilled = sum(
+            self.conn.execute(
+                f"UPDATE {table} SET prize = ?, house_cut = ? WHERE prize IS NULL",
+                (LEGACY_PRIZE, LEGACY_HOUSE_CUT),
+            ).rowcount
+            for table in ("tables", "tables_archive")
+        )
+        if backfilled or not self.conn.execute("SELECT 1 FROM totals").fetchone():
+            # a new database, one from before totals were kept, or totals
+            # that counted older tables as paying nothing
+            self.conn.execute("DELETE FROM totals")
+            self._add_totals(self.recompute_totals())
+        self._record_opening_balances()
+        self.conn.commit()
+
+    def close(self) -> None:
+        if self.conn is None:
+            return
+        self.snapshot()
+        self.conn.close()
+        self.conn = None
+
+    def snapshot(self) -> bool:
+        self.flush()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+
+    def _sync(self) -> None:
+        self.conn.commit()
+
+    def _write(self, sql: str, *params: Any) -> sqlite3.Cursor:
+        # runs inside the implicit transaction that flush() commits
+        return self.conn.execute(sql, params)
+
+    # ---------- players / promoters ----------
+
+    def player(self, uid: int) -> Optional[Player]:
+        row = self.conn.execute(
+            "SELECT * FROM players WHERE id = ?", (uid,)
+        ).fetchone()
+        return None if row is None else _player_row(row)
+
+    def create_player(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Player:
+        self._write(
+            "INSERT INTO players (id, username, username_key, first_name)"
+            " VALUES (?, ?, ?, ?)",
+            uid, username, _username_key(username), first_name,
+        )
+        self._claim_username(uid, username)
+        self._mutated()
+        return self.player(uid)
+
+    def rename_player(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Player:
+        self._write(
+            "UPDATE players SET username = ?, username_key = ?, first_name = ?"
+            " WHERE id = ?",
+            username, _username_key(username), first_name, uid,
+        )
+        self._claim_username(uid, username)
+        self._mutated()
+        return self.player(uid)
+
+    def _claim_username(self, uid: int, username: Optional[str]) -> None:
+        # Telegram lets a freed username be taken by someone else; the
+        # newest holder wins and the older record loses it
+        if username:
+            self._write(
+                "UPDATE players SET username = NULL, username_key = NULL"
+                " WHERE username_key = ? AND id != ?",
+                _username_key(username), uid,
+            )
+
+    def player_by_username(self, username: str) -> Optional[int]:
+        row = self.conn.execute(
+            "SELECT id FROM players WHERE username_key = ?",
+            (_username_key(username),),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def iter_players(self) -> Iterator[Player]:
+        for row in self.conn.execute("SELECT * FROM players ORDER BY id"):
+            yield _player_row(row)
+
+    def promoter(self, uid: int) -> Optional[Promoter]:
+        row = self.conn.execute(
+            "SELECT * FROM promoters WHERE id = ?", (uid,)
+        ).fetchone()
+        return None if row is None else _promoter_row(row)
+
+    def create_promoter(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Promoter:
+        self._write(
+            "INSERT INTO promoters (id, username, first_name, promo_code)"
+            " VALUES (?, ?, ?, ?)",
+            uid, username, first_name, f"promo_{uid}",
+        )
+        self._mutated()
+        return self.promoter(uid)
+
+    def rename_promoter(
+        self, uid: int, username: Optional[str], first_name: Optional[str]
+    ) -> Promoter:
+        self._write(
+            "UPDATE promoters SET username = ?, first_name = ? WHERE id = ?",
+            username, first_name, uid,
+        )
+        self._mutated()
+        return self.promoter(uid)
+
+    def refer_player(self, uid: int, promoter_id: int) -> None:
+        self._write(
+            "UPDATE players SET referred_by = ? WHERE id = ?",
+            promoter_id, uid,
+        )
+        self._write(
+            "UPDATE promoters SET referred_players = referred_players + 1"
+            " WHERE id = ?",
+            promoter_id,
+        )
+        self._mutated()
+
+    def accrue_payout(
+        self, promoter_id: int, amount: float, table_id: Optional[int] = None
+    ) -> None:
+        self._write(
+            "UPDATE promoters SET pending_payout = pending_payout + ? WHERE id = ?",
+            amount, promoter_id,
+        )
+        self._add_totals(Totals(pending_payouts=amount))
+        self._record(
+            "promo_bonus", promoter_account(promoter_id), HOUSE, amount, table_id
+        )
+        self._mutated()
+
+    def iter_promoters(
+        self, by: str = "id", after: Optional[tuple] = None
+    ) -> Iterator[Promoter]:
+        if by == "balance":
+            order = "pending_payout DESC, id"
+            past = "pending_payout < ? OR (pending_payout = ? AND id > ?)"
+            params = () if after is None else (-after[0], -after[0], after[1])
+        elif by == "id":
+            order, past = "id", "id > ?"
+            params = () if after is None else after
+        else:
+            raise ValueError(f"Unknown promoter order: {by}")
+        where = "" if after is None else f" WHERE {past}"
+        for row in self.conn.execute(
+            f"SELECT * FROM promoters{where} ORDER BY {order}", params
+        ):
+            yield _promoter_row(row)
+
+    # ---------- tables ----------
+
+    def table(self, table_id: int) -> Optional[Table]:
+        row = self.conn.execute(
+            "SELECT * FROM tables WHERE id = ?", (table_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        seats = self.conn.execute(
+            "SELECT player_id FROM seats WHERE table_id = ? ORDER BY seat",
+            (table_id,),
+        )
+        return Table(
+            row["id"],
+            row["buy_in"],
+            row["status"],
+            [seat[0] for seat in seats],
+            row["winner_id"],
+            finished_at=row["finished_at"],
+            prize=row["prize"],
+            house_cut=row["house_cut"],
+            pool=row["pool"],
+            size=row["size"],
+        )
+
+    def waiting_table(self, pool: Optional[str], size: int) -> Optional[Table]:
+        row = self.conn.execute(
+            "SELECT id FROM tables WHERE pool IS ? AND status = 'waiting'"
+            " AND (SELECT COUNT(*) FROM seats WHERE table_id = tables.id)"
+            " < COALESCE(size, ?)"
+            " ORDER BY id LIMIT 1",
+            (pool, size),
+        ).fetchone()
+        return None if row is None else self.table(row[0])
+
+    def create_table(
+        self, buy_in: int, prize: int, house_cut: int, pool: str, size: int
+    ) -> Table:
+        # ids of archived tables must not be handed out again
+        cur = self._write(
+            "INSERT INTO tables (id, status, buy_in, prize, house_cut, pool, size)"
+            " VALUES (MAX(COALESCE((SELECT MAX(id) FROM tables), 0),"
+            " COALESCE((SELECT MAX(id) FROM tables_archive), 0)) + 1,"
+            " 'waiting', ?, ?, ?, ?, ?)",
+            buy_in, prize, house_cut, pool, size,
+        )
+        table = self.table(cur.lastrowid)
+        self._recount(None, table)
+        self._mutated()
+        return table
+
+    def join_table(self, table_id: int, uid: int) -> Table:
+        self._write(
+            "INSERT INTO seats (table_id, seat, player_id) VALUES"
+            " (?, (SELECT COUNT(*) FROM seats WHERE table_id = ?), ?)",
+            table_id, table_id, uid,
+        )
+        self._write(
+            "UPDATE players SET joined_tables = joined_tables + 1 WHERE id = ?",
+            uid,
+        )
+        table = self.table(table_id)
+        self._record(
+            "buy_in",
+            table_account(table_id),
+            player_account(uid),
+            table.buy_in,
+            table_id,
+        )
+        self._mutated()
+        return table
+
+    def start_table(self, table_id: int) -> Table:
+        before = self.table(table_id)
+        self._write("UPDATE tables SET status = 'running' WHERE id = ?", table_id)
+        after = self.table(table_id)
+        self._recount(before, after)
+        self._mutated()
+        return after
+
+    def finish_table(self, table_id: int, winner_uid: int) -> Table:
+        before = self.table(table_id)
+        self._write(
+            "UPDATE tables SET status = 'finished', winner_id = ?, finished_at = ?"
+            " WHERE id = ?",
+            winner_uid, time.time(), table_id,
+        )
+        self._write(
+            "UPDATE players SET wins = wins + 1 WHERE id = ?", winner_uid
+        )
+        after = self.table(table_id)
+        self._recount(before, after)
+        self._record_finish(after)
+        self._mutated()
+        return after
+
+    def cancel_table(self, table_id: int) -> Table:
+        before = self.table(table_id)
+        self._write(
+            "UPDATE tables SET status = 'cancelled', finished_at = ? WHERE id = ?",
+            time.time(), table_id,
+        )
+        after = self.table(table_id)
+        self._recount(before, after)
+        self._record_refunds(after)
+        self._mutated()
+        return after
+
+    def iter_tables(
+        self, status: Optional[str] = None, after: int = 0
+    ) -> Iterator[Table]:
+        where, params = "t.id > ?", [after]
+        if status is not None:
+            where += " AND t.status = ?"
+            params.append(status)
+        rows = self.conn.execute(
+            "SELECT t.id, t.status, t.buy_in, t.winner_id, t.finished_at,"
+            " t.prize, t.house_cut, t.pool, t.size,"
+            " GROUP_CONCAT(s.player_id) AS players"
+            " FROM tables t LEFT JOIN seats s ON s.table_id = t.id"
+            f" WHERE {where} GROUP BY t.id ORDER BY t.id",
+            params,
+        )
+        for row in rows:
+            yield Table(
+                row["id"],
+                row["buy_in"],
+                row["status"],
+                _split_ids(row["players"]),
+                row["winner_id"],
+                finished_at=row["finished_at"],
+                prize=row["prize"],
+                house_cut=row["house_cut"],
+                pool=row["pool"],
+                size=row["size"],
+            )
+
+    def archive_tables(self, finished_before: float) -> int:
+        done = (
+            "status IN ('finished', 'cancelled') AND COALESCE(finished_at, 0) <= ?"
+        )
+        self._write(
+            "INSERT INTO tables_archive (id, buy_in, winner_id, finished_at,"
+            " prize, house_cut, status, pool, size, players)"
+            " SELECT id, buy_in, winner_id, finished_at, prize, house_cut, status,"
+            " pool, size,"
+            " COALESCE((SELECT GROUP_CONCAT(player_id) FROM (SELECT player_id"
+            " FROM seats WHERE table_id = tables.id ORDER BY seat)), '')"
+            f" FROM tables WHERE {done} ORDER BY id",
+            finished_before,
+        )
+        self._write(
+            f"DELETE FROM seats WHERE table_id IN (SELECT id FROM tables WHERE {done})",
+            finished_before,
+        )
+        moved = self._write(f"DELETE FROM tables WHERE {done}", finished_before).rowcount
+        if moved:
+            self._mutated()
+        return moved
+
+    def archived_count(self) -> int:
+        # append-only, so seq runs 1..n without gaps
+        return self.conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM tables_archive"
+        ).fetchone()[0]
+
+    def archived_tables(self, offset: int, limit: int) -> List[Table]:
+        rows = self.conn.execute(
+            "SELECT * FROM tables_archive ORDER BY seq DESC LIMIT ? OFFSET ?",
+            (limit, offset),
+        )
+        return [
+            Table(
+                row["id"],
+                row["buy_in"],
+                row["status"],
+                _split_ids(row["players"]),
+                row["winner_id"],
+                finished_at=row["finished_at"],
+                prize=row["prize"],
+                house_cut=row["house_cut"],
+                pool=row["pool"],
+                size=row["size"],
+            )
+            for row in rows
+        ]
+
+    # ---------- totals ----------
+
+    def totals(self) -> Totals:
+        values, by_week = {}, {}
+        for name, value in self.conn.execute("SELECT name, value FROM totals"):
+            if name.startswith("house_cut:"):
+                by_week[name.split(":", 1)[1]] = value
+            else:
+                values[name] = value
+        totals = Totals.from_dict(values)
+        totals.house_cut_by_week = by_week
+        return totals
+
+    def _recount(self, before: Optional[Table], after: Table) -> None:
+        delta = Totals()
+        if before is not None:
+            _count_table(delta, before, -1)
+        _count_table(delta, after)
+        self._add_totals(delta)
+
+    def _add_totals(self, delta: Totals) -> None:
+        changes = [
+            (name, value)
+            for name, value in delta.to_dict().items()
+            if name != "house_cut_by_week" and value
+        ]
+        changes.extend(
+            (f"house_cut:{week}", value)
+            for week, value in delta.house_cut_by_week.items()
+            if value
+        )
+        self.conn.executemany(
+            "INSERT INTO totals (name, value) VALUES (?, ?)"
+            " ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            changes,
+        )
+
+    # ---------- ledger ----------
+
+    def iter_ledger(self, after: int = 0) -> Iterator[LedgerEntry]:
+        rows = self.conn.execute(
+            "SELECT * FROM ledger WHERE id > ? ORDER BY id", (after,)
+        )
+        for row in rows:
+            yield LedgerEntry(
+                row["id"],
+                row["at"],
+                row["kind"],
+                row["debit"],
+                row["credit"],
+                row["amount"],
+                row["table_id"],
+                row["batch"],
+            )
+
+    def _record(
+        self,
+        kind: str,
+        debit: str,
+        credit: str,
+        amount: float,
+        table_id: Optional[int] = None,
+        batch: Optional[int] = None,
+    ) -> LedgerEntry:
+        at = time.time()
+        cur = self._write(
+            "INSERT INTO ledger (at, kind, debit, credit, amount, table_id, batch)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            at, kind, debit, credit, amount, table_id, batch,
+        )
+        return LedgerEntry(
+            cur.lastrowid, at, kind, debit, credit, amount, table_id, batch
+        )
+
+    def _last_settlement(self) -> int:
+        row = self.conn.execute(
+            "SELECT MAX(batch) FROM ledger WHERE batch IS NOT NULL"
+        ).fetchone()
+        return row[0] or 0
+
+    def _mark_paid(self, batch: int, payouts: Dict[int, LedgerEntry]) -> None:
+        self.conn.executemany(
+            "UPDATE promoters SET pending_payout = pending_payout - ?,"
+            " total_paid = total_paid + ? WHERE id = ?",
+            [(e.amount, e.amount, pid) for pid, e in payouts.items()],
+        )
+        paid = sum(e.amount for e in payouts.values())
+        self._add_totals(Totals(pending_payouts=-paid, paid_out=paid))
+        self._mutated()
+
+
+def _split_ids(joined: Optional[str]) -> List[int]:
+    return [int(uid) for uid in joined.split(",")] if joined else []
+
+
+def _username_key(username: Optional[str]) -> Optional[str]:
+    return username.casefold() if username else None
+
+
+def _player_row(row: sqlite3.Row) -> Player:
+    return Player(
+        row["id"],
+        row["username"],
+        row["first_name"],
+        row["joined_tables"],
+        row["wins"],
+        row["referred_by"],
+        row["promo_code"],
+    )
+
+
+def _promoter_row(row: sqlite3.Row) -> Promoter:
+    return Promoter(
+        row["id"],
+        row["username"],
+        row["first_name"],
+        row["promo_code"],
+        row["referred_players"],
+        row["pending_payout"],
+        row["total_paid"],
+    )
@@ -0,0 +1,116 @@
+import asyncio
+from types import SimpleNamespace
+
+from lobby import Lobby, TapGuard
+
+
+class FakeOutbox:
+    """Records calls; edits fail (resolve to None) when ``edits_fail``."""
+
+    def __init__(self, edits_fail: bool = False):
+        self.edits_fail = edits_fail
+        self.calls = []
+        self._ids = iter(range(100, 200))
+
+    def _done(self, result):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(result)
+        return future
+
+    async def send(self, chat_id, text, priority=1, **kwargs):
+        self.calls.append(("send", text, kwargs.get("reply_to_message_id")))
+        return self._done(SimpleNamespace(message_id=next(self._ids)))
+
+    async def edit(self, chat_id, message_id, text, priority=1, **kwargs):
+        self.calls.append(("edit", text, message_id))
+        return self._done(None if self.edits_fail else SimpleNamespace())
+
+
+def run_lobby(outbox: FakeOutbox, steps) -> list:
+    async def run():
+        lobby = Lobby(outbox, debounce=0)
+        steps(lobby)
+        await lobby.drain()
+        return outbox.calls
+
+    return asyncio.run(run())
+
+
+def test_start_announcement_is_a_new_message_under_the_lobby():
+    def steps(lobby):
+        lobby.update(1, -100, lambda: ("1/2", None))
+        lobby.close(1, "full", announcement="running")
+
+    assert run_lobby(FakeOutbox(), steps) == [
+        ("send", "1/2", None),
+        ("send", "running", 100),
+        ("edit", "full", 100),
+    ]
+
+
+def test_closing_text_is_sent_anew_when_the_lobby_cannot_be_edited():
+    def steps(lobby):
+        lobby.update(1, -100, lambda: ("1/2", None))
+        lobby.close(1, "expired")
+
+    assert run_lobby(FakeOutbox(edits_fail=True), steps) == [
+        ("send", "1/2", None),
+        ("edit", "expired", 100),
+        ("send", "expired", None),
+    ]
+
+
+def test_closing_a_table_without_a_lobby_message():
+    answered = []
+
+    async def answer():
+        answered.append(True)
+
+    def steps(lobby):
+        assert lobby.close(1, "full", answer, announcement="running") is None
+
+    assert run_lobby(FakeOutbox(), steps) == []
+    assert answered == [True]
+
+
+def test_tap_guard_ignores_redelivered_queries():
+    guard = TapGuard()
+    assert not guard.seen("q1")
+    assert guard.seen("q1")
+    assert not guard.seen("q2")
+
+
+def test_tap_guard_shares_the_first_taps_outcome():
+    async def run():
+        guard = TapGuard()
+        assert guard.earlier("tap") is None
+        repeat = guard.earlier("tap")
+        assert repeat is not None and not repeat.done()
+        guard.settle("tap", "You joined table #1.")
+        assert await repeat == "You joined table #1."
+        assert guard.repeats == 1
+
+    asyncio.run(run())
+
+
+def test_tap_guard_forgets_a_failed_tap():
+    async def run():
+        guard = TapGuard()
+        guard.earlier("tap")
+        repeat = guard.earlier("tap")
+        guard.forget("tap")
+        assert await repeat is None
+        assert guard.earlier("tap") is None  # the next tap tries again
+
+    asyncio.run(run())
+
+
+def test_tap_guard_window_expires():
+    async def run():
+        guard = TapGuard(window=0)
+        assert guard.earlier("tap") is None
+        assert guard.earlier("tap") is None
+        assert not guard.seen("q1")
+        assert not guard.seen("q1")
+
+    asyncio.run(run())
@@ -0,0 +1,91 @@
+"""Outbox queueing: which messages go first and which are dropped when the
+queue is full."""
+import asyncio
+
+from outbox import HIGH, LOW, NORMAL, Outbox
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return text
+
+    edit_message_text = send_message
+
+
+async def held_outbox(**kwargs) -> Outbox:
+    """A started outbox that queues but sends nothing until release()."""
+    outbox = Outbox(global_rate=0, chat_rate=0, group_rate=0, **kwargs)
+    await outbox.start(FakeBot())
+    outbox._paused_until = float("inf")
+    return outbox
+
+
+async def release(outbox: Outbox) -> list:
+    outbox._paused_until = 0.0
+    outbox._wakeup.set()
+    await outbox.stop(1.0)
+    return outbox.bot.sent
+
+
+def test_full_queue_evicts_the_oldest_low_message():
+    async def run():
+        outbox = await held_outbox(max_queued=2)
+        oldest = await outbox.send(1, "a", LOW)
+        await outbox.send(2, "b", LOW)
+        newest = await outbox.send(1, "c", LOW)
+        assert oldest.done() and oldest.result() is None
+        assert newest is not None
+        assert outbox.dropped == 1
+        assert await release(outbox) == [(2, "b"), (1, "c")]
+
+    asyncio.run(run())
+
+
+def test_full_queue_without_low_messages_refuses_a_low_one():
+    async def run():
+        outbox = await held_outbox(max_queued=2)
+        await outbox.send(1, "a", NORMAL)
+        await outbox.send(1, "b", NORMAL)
+        assert await outbox.send(1, "c", LOW) is None
+        assert outbox.dropped == 1
+        assert await release(outbox) == [(1, "a"), (1, "b")]
+
+    asyncio.run(run())
+
+
+def test_higher_priorities_go_first():
+    async def run():
+        outbox = await held_outbox()
+        await outbox.send(1, "low", LOW)
+        await outbox.send(2, "high", HIGH)
+        await outbox.send(3, "normal", NORMAL)
+        assert await release(outbox) == [(2, "high"), (3, "normal"), (1, "low")]
+
+    asyncio.run(run())
+
+
+def test_a_chat_gets_its_messages_in_order():
+    async def run():
+        outbox = await held_outbox()
+        await outbox.send(1, "first", LOW)
+        await outbox.send(1, "second", HIGH)
+        await outbox.send(2, "other", NORMAL)
+        assert await release(outbox) == [(2, "other"), (1, "first"), (1, "second")]
+
+    asyncio.run(run())
+
+
+def test_messages_resolve_to_what_the_bot_returned():
+    async def run():
+        outbox = await held_outbox()
+        sent = await outbox.send(1, "hello")
+        edited = await outbox.edit(1, 7, "hello again")
+        await release(outbox)
+        assert (await sent, await edited) == ("hello", "hello again")
+        assert outbox.sent == 2 and outbox.queued == 0
+
+    asyncio.run(run())
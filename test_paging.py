@@ -0,0 +1,77 @@
+from paging import Pager
+
+
+def numbered(count: int, pulled=None):
+    """A source of ``count`` lines; the cursor is the last number shown."""
+
+    def source(after):
+        for n in range((after or 0) + 1, count + 1):
+            if pulled is not None:
+                pulled.append(n)
+            yield n, f"line {n}"
+
+    return source
+
+
+def buttons(markup):
+    if markup is None:
+        return []
+    return [(b.text, b.callback_data) for b in markup.inline_keyboard[0]]
+
+
+def turn_to(pager: Pager, owner: int, markup, label: str):
+    data = dict(buttons(markup))[label]
+    _, listing_id, index = data.split(":")
+    return pager.turn(owner, int(listing_id), int(index))
+
+
+def test_short_listing_is_one_page_without_buttons():
+    text, markup = Pager(page_size=5).open(1, "Tables", "No tables.", numbered(3))
+    assert text == "Tables:\nline 1\nline 2\nline 3"
+    assert markup is None
+
+
+def test_empty_listing_shows_the_empty_text():
+    assert Pager().open(1, "Tables", "No tables.", numbered(0)) == ("No tables.", None)
+
+
+def test_pages_forward_and_back():
+    pager = Pager(page_size=3)
+    text, markup = pager.open(1, "Tables", "", numbered(7))
+    assert text == "Tables, page 1:\nline 1\nline 2\nline 3"
+    assert [label for label, _ in buttons(markup)] == ["Next »"]
+
+    text, markup = turn_to(pager, 1, markup, "Next »")
+    assert text == "Tables, page 2:\nline 4\nline 5\nline 6"
+    assert [label for label, _ in buttons(markup)] == ["« Prev", "Next »"]
+
+    text, markup = turn_to(pager, 1, markup, "Next »")
+    assert text == "Tables, page 3:\nline 7"
+    assert [label for label, _ in buttons(markup)] == ["« Prev"]
+
+    text, _ = turn_to(pager, 1, markup, "« Prev")
+    assert text.startswith("Tables, page 2:\nline 4")
+
+
+def test_a_page_pulls_at_most_one_line_past_it():
+    pulled = []
+    Pager(page_size=3).open(1, "Tables", "", numbered(1000, pulled))
+    assert pulled == [1, 2, 3, 4]
+
+
+def test_long_lines_end_the_page_early():
+    pager = Pager(page_size=10, max_chars=30)
+    text, markup = pager.open(1, "T", "", numbered(10))
+    assert text == "T, page 1:\nline 1\nline 2"
+    assert len(text) <= 30
+    text, _ = turn_to(pager, 1, markup, "Next »")
+    assert text == "T, page 2:\nline 3\nline 4"
+
+
+def test_buttons_of_an_older_listing_expire():
+    pager = Pager(page_size=1)
+    _, old = pager.open(1, "Tables", "", numbered(3))
+    pager.open(1, "Promoters", "", numbered(3))
+    assert turn_to(pager, 1, old, "Next »") is None
+    # each admin has their own listing
+    assert turn_to(pager, 2, old, "Next »") is None
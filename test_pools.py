@@ -0,0 +1,25 @@
+import pytest
+
+from pools import Pool, parse_pools
+
+
+def test_pools_in_configured_order():
+    pools = parse_pools("5:5:5:20:5, 10:2:10:18:2,")
+    assert list(pools) == ["5", "10"]
+    assert pools["10"] == Pool("10", size=2, buy_in=10, prize=18, house_cut=2)
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        "",
+        " , ",
+        "5:5:5:20",  # a field missing
+        "5:5:five:20:5",
+        "5:1:5:4:1",  # a table needs two players
+        "5:5:5:20:4",  # the split does not add up to 5 x $5
+    ],
+)
+def test_bad_specs_are_refused(spec):
+    with pytest.raises(ValueError):
+        parse_pools(spec)
@@ -0,0 +1,182 @@
+"""The repository API against both storage backends: each answers the same,
+before and after a restart."""
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from storage import SqliteStore, StateStore, Storage, promoter_key
+
+
+class Backend:
+    """Opens one backend on one data directory, and restarts it."""
+
+    def __init__(self, name: str, data_dir: Path):
+        self.name = name
+        self.data_dir = data_dir
+        self.opened: List[Storage] = []
+
+    def open(self) -> Storage:
+        if self.name == "sqlite":
+            store: Storage = SqliteStore(self.data_dir / "state.db")
+        else:
+            store = StateStore(
+                self.data_dir / "state.snapshot",
+                self.data_dir / "state.wal",
+                self.data_dir / "tables.archive.jsonl",
+                ledger_file=self.data_dir / "ledger.jsonl",
+            )
+        store.open()
+        self.opened.append(store)
+        return store
+
+    def restart(self, store: Storage) -> Storage:
+        self.opened.remove(store)
+        store.close()
+        return self.open()
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, tmp_path):
+    backend = Backend(request.param, tmp_path)
+    yield backend
+    for store in backend.opened:
+        store.close()
+
+
+def seat_table(store: Storage, uids, pool: str = "5", winner=None) -> int:
+    table = store.create_table(5, 8, 2, pool, len(uids))
+    for uid in uids:
+        if store.player(uid) is None:
+            store.create_player(uid, f"u{uid}", f"U{uid}")
+        store.join_table(table.id, uid)
+    store.start_table(table.id)
+    if winner is not None:
+        store.finish_table(table.id, winner)
+    return table.id
+
+
+def test_usernames_are_unique_and_case_insensitive(backend):
+    store = backend.open()
+    store.create_player(1, "Al", "A")
+    store.create_player(2, "x", "B")
+    assert store.player_by_username("al") == 1
+    store.rename_player(1, "X", "A")  # takes the name from player 2
+
+    for _ in range(2):
+        assert store.player_by_username("al") is None
+        assert store.player_by_username("x") == 1
+        assert store.player(1).username == "X"
+        assert store.player(2).username is None
+        store = backend.restart(store)
+
+
+def test_waiting_tables_are_served_oldest_first_per_pool(backend):
+    store = backend.open()
+    first = store.create_table(5, 8, 2, "5", 2).id
+    other_pool = store.create_table(10, 16, 4, "10", 2).id
+    second = store.create_table(5, 8, 2, "5", 2).id
+    assert store.waiting_table("5", 2).id == first
+    store = backend.restart(store)
+    assert store.waiting_table("5", 2).id == first
+
+    for uid in (1, 2):
+        store.create_player(uid, f"u{uid}", None)
+        store.join_table(first, uid)
+    store.start_table(first)
+    for _ in range(2):
+        assert store.waiting_table("5", 2).id == second
+        assert store.waiting_table("10", 2).id == other_pool
+        store = backend.restart(store)
+
+
+def test_tables_page_in_id_order_across_snapshots(backend):
+    store = backend.open()
+    for _ in range(6):
+        store.create_table(5, 8, 2, "5", 2)
+    store.snapshot()
+    for _ in range(4):
+        store.create_table(5, 8, 2, "5", 2)
+    store.snapshot()
+    seat_table(store, [1, 2])  # table 11
+
+    store = backend.restart(store)
+    assert [t.id for t in store.iter_tables()] == list(range(1, 12))
+    assert [t.id for t in store.iter_tables(after=6)] == list(range(7, 12))
+    assert [t.id for t in store.iter_tables("running")] == [11]
+    assert [t.id for t in store.iter_tables("waiting", after=9)] == [10]
+
+
+def test_money_moves_are_in_the_ledger_and_the_totals(backend):
+    store = backend.open()
+    store.create_promoter(9, "p", "P")
+    finished = seat_table(store, [1, 2], winner=1)
+    store.refer_player(1, 9)
+    store.accrue_payout(9, 2.0, finished)
+    cancelled = store.create_table(5, 8, 2, "5", 2).id
+    store.join_table(cancelled, 2)
+    store.cancel_table(cancelled)
+
+    for _ in range(2):
+        assert [(e.kind, e.amount) for e in store.iter_ledger()] == [
+            ("buy_in", 5),
+            ("buy_in", 5),
+            ("prize", 8),
+            ("house_cut", 2),
+            ("promo_bonus", 2),
+            ("buy_in", 5),
+            ("refund", 5),
+        ]
+        totals = store.totals()
+        assert (totals.prizes, totals.house_cut, totals.pending_payouts) == (8, 2, 2)
+        assert (totals.finished, totals.cancelled) == (1, 1)
+        assert totals == store.recompute_totals()
+        assert store.player(1).wins == 1
+        store = backend.restart(store)
+
+    paid = store.settle_payouts()
+    assert [(pid, e.kind, e.amount) for pid, e in paid.items()] == [(9, "payout", 2)]
+    assert store.settle_payouts() == {}
+    store = backend.restart(store)
+    promoter = store.promoter(9)
+    assert (promoter.pending_payout, promoter.total_paid) == (0, 2)
+    assert store.totals() == store.recompute_totals()
+
+
+def test_promoters_page_by_id_and_by_balance(backend):
+    store = backend.open()
+    for pid, balance in [(4, 1.0), (1, 3.0), (3, 3.0), (2, 0.0), (5, 7.0)]:
+        store.create_promoter(pid, f"p{pid}", None)
+        if balance:
+            store.accrue_payout(pid, balance)
+
+    for _ in range(2):
+        by_id = [p.id for p in store.iter_promoters("id")]
+        assert by_id == [1, 2, 3, 4, 5]
+        by_balance = list(store.iter_promoters("balance"))
+        assert [p.id for p in by_balance] == [5, 1, 3, 4, 2]
+        after = promoter_key("balance", by_balance[1])
+        assert [p.id for p in store.iter_promoters("balance", after)] == [3, 4, 2]
+        store = backend.restart(store)
+
+    store.accrue_payout(2, 10.0)
+    assert [p.id for p in store.iter_promoters("balance")][:2] == [2, 5]
+    with pytest.raises(ValueError):
+        list(store.iter_promoters("name"))
+
+
+def test_archived_tables_leave_the_live_state(backend):
+    store = backend.open()
+    ids = [seat_table(store, [1, 2], winner=1) for _ in range(3)]
+    running = seat_table(store, [3, 4])
+    before = store.totals()
+    assert store.archive_tables(float("inf")) == 3
+
+    for _ in range(2):
+        assert store.archived_count() == 3
+        assert [t.id for t in store.archived_tables(0, 2)] == ids[::-1][:2]
+        assert [t.id for t in store.archived_tables(2, 2)] == ids[:1]
+        assert store.table(ids[0]) is None
+        assert [t.id for t in store.iter_tables()] == [running]
+        assert store.totals() == before == store.recompute_totals()
+        store = backend.restart(store)
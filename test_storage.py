@@ -0,0 +1,320 @@
+"""Recovery paths of the JSON state store: what a restart finds on disk
+after a clean shutdown, a crash, or an older version of the bot."""
+import argparse
+import asyncio
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+
+import snapshots
+from serialization import get_serializer
+from storage import StateStore, read_snapshot
+
+
+def open_store(data_dir: Path, serializer: str = "json") -> StateStore:
+    store = StateStore(
+        data_dir / "state.json",
+        data_dir / "state.wal",
+        data_dir / "tables.archive.jsonl",
+        serializer=get_serializer(serializer),
+        ledger_file=data_dir / "ledger.jsonl",
+    )
+    store.open()
+    return store
+
+
+def crash(store: StateStore, data_dir: Path, copy_to: Path) -> Path:
+    """The files as a crash right now would leave them: whatever the writer
+    finished, nothing still pending in memory."""
+    if store._written is not None:
+        store._written.result()
+    shutil.copytree(data_dir, copy_to)
+    return copy_to
+
+
+def kill(store: StateStore) -> None:
+    """Stop the store as a crash would: nothing more is written, only its
+    files are let go."""
+    store._writer.shutdown()
+    store._wal.close()
+    store._ledger.close()
+    store._wal = None
+
+
+def seat_table(store: StateStore, uids, winner=None) -> int:
+    table = store.create_table(5, 20, 5, "5", len(uids))
+    for uid in uids:
+        if store.player(uid) is None:
+            store.create_player(uid, f"u{uid}", f"U{uid}")
+        store.join_table(table.id, uid)
+    store.start_table(table.id)
+    if winner is not None:
+        store.finish_table(table.id, winner)
+    return table.id
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    path = tmp_path / "data"
+    path.mkdir()
+    return path
+
+
+def test_snapshot_plus_delta_replay(data_dir, tmp_path):
+    store = open_store(data_dir)
+    seat_table(store, [1, 2], winner=1)
+    store.create_promoter(9, None, None)
+    store.snapshot()
+    table_id = seat_table(store, [3, 4])
+    store.accrue_payout(9, 2.0)
+    store.drain()
+
+    restarted = open_store(crash(store, data_dir, tmp_path / "crashed"))
+    assert restarted.seq == store.seq
+    assert restarted.table(table_id).status == "running"
+    assert restarted.promoter(9).pending_payout == 2.0
+    assert restarted.totals() == restarted.recompute_totals()
+    assert list(restarted.iter_ledger()) == list(store.iter_ledger())
+    store.close()
+    restarted.close()
+
+
+@pytest.mark.parametrize("serializer", ["json", "pickle"])
+def test_tables_stay_in_id_order_across_snapshots(data_dir, serializer):
+    store = open_store(data_dir, serializer)
+    for _ in range(6):
+        store.create_table(5, 20, 5, "5", 2)
+    store.snapshot()
+    for _ in range(4):
+        store.create_table(5, 20, 5, "5", 2)
+    store.snapshot()
+    store.close()
+
+    restarted = open_store(data_dir, serializer)
+    assert [t.id for t in restarted.iter_tables()] == list(range(1, 11))
+    assert [t.id for t in restarted.iter_tables(after=6)] == [7, 8, 9, 10]
+    assert restarted.waiting_table("5", 5).id == 1
+    restarted.close()
+
+
+def test_torn_wal_record_is_cut_off(data_dir):
+    store = open_store(data_dir)
+    store.create_player(1, "a", "A")
+    store.close()
+    store = open_store(data_dir)
+    store.create_player(2, "b", "B")
+    store.drain()
+    kill(store)
+    good = (data_dir / "state.wal").stat().st_size
+    with (data_dir / "state.wal").open("a", encoding="utf-8") as f:
+        f.write('{"op":"player_created","uid":3,"user')  # crash mid-append
+
+    restarted = open_store(data_dir)
+    assert restarted.player(2) is not None
+    assert restarted.player(3) is None
+    assert (data_dir / "state.wal").stat().st_size == good
+    restarted.create_player(3, "c", "C")
+    restarted.close()
+    restarted = open_store(data_dir)
+    assert restarted.player(3).username == "c"
+    restarted.close()
+
+
+def test_crash_inside_a_call_keeps_state_and_ledger_together(data_dir, tmp_path):
+    store = open_store(data_dir)
+    seat_table(store, [1, 2])
+    store.create_promoter(9, None, None)
+    store.drain()
+    store.flush_max_pending = 1
+    record = store._record
+
+    def crash_before_entry(*args, **kwargs):
+        crash(store, data_dir, tmp_path / "crashed")
+        return record(*args, **kwargs)
+
+    store._record = crash_before_entry
+    store.accrue_payout(9, 2.0)
+    store.close()
+
+    restarted = open_store(tmp_path / "crashed")
+    assert restarted.promoter(9).pending_payout == 0
+    assert not [e for e in restarted.iter_ledger() if e.kind == "promo_bonus"]
+    restarted.close()
+
+
+def test_commit_raises_after_a_failed_flush(data_dir):
+    store = open_store(data_dir)
+    store.flush_max_pending = 1
+
+    def disk_full(data):
+        raise OSError("No space left on device")
+
+    store._append_wal = disk_full
+    store.create_player(1, "a", "A")  # flushed at once, nobody waiting
+    store._written.exception()  # let the writer get to it first
+    with pytest.raises(OSError):
+        asyncio.run(store.commit())
+    kill(store)
+
+
+def test_legacy_state_json(data_dir):
+    # the plain state dict the bot wrote before snapshots and the WAL
+    players = {
+        str(uid): {
+            "id": uid,
+            "username": f"u{uid}",
+            "first_name": f"U{uid}",
+            "joined_tables": 1,
+            "wins": 0,
+            "referred_by": "9" if uid == 1 else None,
+            "promo_code": None,
+        }
+        for uid in (1, 2)
+    }
+    legacy = {
+        "tables": {
+            "1": {
+                "id": 1,
+                "status": "running",
+                "buy_in": 5,
+                "players": ["1", "2"],
+                "winner_id": None,
+                "promoters": {"9": 1},
+            }
+        },
+        "next_table_id": 2,
+        "players": players,
+        "promoters": {
+            "9": {
+                "id": 9,
+                "username": "p",
+                "first_name": "P",
+                "promo_code": "promo_9",
+                "referred_players": 1,
+                "pending_payout": 4.0,
+                "total_paid": 0.0,
+            }
+        },
+    }
+    (data_dir / "state.json").write_text(json.dumps(legacy))
+
+    store = open_store(data_dir)
+    table = store.table(1)
+    assert table.players == [1, 2]
+    assert (table.prize, table.house_cut) == (20, 5)  # the split of the time
+    assert store.player(1).referred_by == 9
+    assert store.player_by_username("U2") == 2
+    assert store.totals().prize_liability == 20
+    assert store.totals().pending_payouts == 4.0
+    # balances from before the ledger are carried over once
+    assert [e.kind for e in store.iter_ledger()] == ["opening"]
+    store.finish_table(1, 2)
+    store.close()
+
+    store = open_store(data_dir)
+    assert json.loads((data_dir / "state.json").read_text())["format"] == 3
+    assert store.totals() == store.recompute_totals()
+    assert [e.kind for e in store.iter_ledger()] == ["opening", "prize", "house_cut"]
+    store.close()
+
+
+def test_converting_a_legacy_state_json_recomputes_its_totals(data_dir):
+    legacy = {
+        "tables": {
+            "1": {"id": 1, "status": "running", "buy_in": 5, "players": ["1", "2"]}
+        },
+        "next_table_id": 2,
+        "players": {
+            str(uid): {"id": uid, "username": f"u{uid}", "first_name": "U"}
+            for uid in (1, 2)
+        },
+        "promoters": {},
+    }
+    (data_dir / "state.json").write_text(json.dumps(legacy))
+    snapshot = data_dir / "state.snapshot"
+    snapshots.convert(
+        argparse.Namespace(snapshot=data_dir / "state.json", to="pickle", out=snapshot)
+    )
+
+    state, _ = read_snapshot(snapshot)
+    assert state["totals"].prize_liability == 20
+    assert state["totals"].running == 1
+
+
+def test_format_1_snapshot_and_string_id_records(data_dir):
+    state = {
+        "tables": {
+            "1": {"id": 1, "status": "waiting", "buy_in": 5, "players": ["1"]}
+        },
+        "next_table_id": 2,
+        "players": {"1": {"id": 1, "username": "a", "first_name": "A"}},
+        "promoters": {},
+    }
+    (data_dir / "state.json").write_text(
+        json.dumps({"format": 1, "seq": 4, "state": state})
+    )
+    (data_dir / "state.wal").write_text(
+        '{"op":"player_created","uid":"2","username":"b","first_name":"B","seq":5}\n'
+        '{"op":"table_joined","table_id":"1","uid":"2","seq":6}\n'
+    )
+
+    store = open_store(data_dir)
+    assert store.seq == 6
+    assert store.table(1).players == [1, 2]
+    assert store.player_by_username("b") == 2
+    assert store.waiting_table(None, 5).id == 1
+    store.close()
+
+
+def test_archive_and_ledger_are_cut_back_to_what_the_state_knows(data_dir, tmp_path):
+    store = open_store(data_dir)
+    seat_table(store, [1, 2], winner=1)
+    store.archive_tables(float("inf"))
+    store.snapshot()
+    store.drain()
+    archive_size = (data_dir / "tables.archive.jsonl").stat().st_size
+    ledger_size = (data_dir / "ledger.jsonl").stat().st_size
+    # an archive pass and a ledger append that never got their delta records
+    with (data_dir / "tables.archive.jsonl").open("ab") as f:
+        f.write(b'{"id":99,"buy_in":5,"status":"finished"}\n')
+    with (data_dir / "ledger.jsonl").open("ab") as f:
+        f.write(b'{"id":999,"at":0,"kind":"prize"')
+    kill(store)
+
+    restarted = open_store(data_dir)
+    assert (data_dir / "tables.archive.jsonl").stat().st_size == archive_size
+    assert (data_dir / "ledger.jsonl").stat().st_size == ledger_size
+    assert restarted.archived_count() == 1
+    assert [t.id for t in restarted.archived_tables(0, 10)] == [1]
+    last_entry = max(e.id for e in restarted.iter_ledger())
+    assert last_entry == restarted.state["ledger_entries"]
+    restarted.close()
+
+
+def test_refuses_to_start_when_an_appendix_lost_data(data_dir):
+    store = open_store(data_dir)
+    seat_table(store, [1, 2], winner=1)
+    store.close()
+    ledger = data_dir / "ledger.jsonl"
+    ledger.write_bytes(ledger.read_bytes()[:-10])
+    with pytest.raises(RuntimeError, match="shorter"):
+        open_store(data_dir)
+
+
+def test_username_takeover_survives_restart(data_dir, tmp_path):
+    store = open_store(data_dir)
+    store.create_player(20, "x", "Twenty")
+    store.create_player(10, "a", "Ten")
+    store.snapshot()
+    store.rename_player(10, "x", "Ten")
+    store.drain()
+
+    replayed = open_store(crash(store, data_dir, tmp_path / "crashed"))
+    assert replayed.player_by_username("x") == 10
+    replayed.close()
+    store.close()
+    restarted = open_store(data_dir)
+    assert restarted.player_by_username("x") == 10
+    restarted.close()
@@ -0,0 +1,41 @@
+from timers import TimerHeap
+
+
+def test_due_keys_come_out_in_deadline_order():
+    timers = TimerHeap()
+    timers.schedule("b", 20)
+    timers.schedule("a", 10)
+    timers.schedule("c", 30)
+    assert timers.pop_due(5) == []
+    assert timers.pop_due(25) == ["a", "b"]
+    assert "a" not in timers and "c" in timers
+    assert len(timers) == 1
+
+
+def test_rescheduling_replaces_the_earlier_deadline():
+    timers = TimerHeap()
+    timers.schedule("a", 10)
+    timers.schedule("a", 50)
+    assert timers.pop_due(20) == []
+    assert timers.pop_due(50) == ["a"]
+    assert timers.pop_due(100) == []
+
+
+def test_cancelled_keys_never_come_due():
+    timers = TimerHeap()
+    timers.schedule("a", 10)
+    timers.schedule("b", 10)
+    timers.cancel("a")
+    timers.cancel("missing")
+    assert timers.pop_due(10) == ["b"]
+
+
+def test_stale_entries_do_not_pile_up():
+    timers = TimerHeap()
+    for deadline in range(1000):
+        timers.schedule("a", deadline)
+        timers.schedule("b", deadline)
+    assert len(timers) == 2
+    assert len(timers._heap) <= 2 * len(timers) + 16
+    assert timers.pop_due(998) == []
+    assert sorted(timers.pop_due(999)) == ["a", "b"]
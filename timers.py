@@ -0,0 +1,43 @@
+import heapq
+from typing import Dict, Hashable, List, Tuple
+
+# ---------- TIMERS ----------
+# Deadlines keyed by id, in a binary min-heap ordered by deadline. Moving or
+# cancelling a deadline does not search the heap: the old entry stays behind
+# and is recognised as stale (its deadline no longer matches) when it
+# surfaces. Once stale entries outnumber the live ones the heap is rebuilt,
+# so every operation is O(log n) amortized and the heap stays O(n).
+
+
+class TimerHeap:
+    def __init__(self):
+        self._heap: List[Tuple[float, Hashable]] = []
+        self._deadlines: Dict[Hashable, float] = {}  # key -> its live deadline
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """Set ``key``'s deadline, replacing any earlier one."""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._heap = [(d, k) for k, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key: Hashable) -> None:
+        self._deadlines.pop(key, None)
+
+    def pop_due(self, now: float) -> List[Hashable]:
+        """Remove and return every key whose deadline is at or before ``now``."""
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+        return due
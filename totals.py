@@ -0,0 +1,82 @@
+"""Check the running totals behind /summary, and the ledger, the slow way.
+
+    python totals.py --backend sqlite --data-dir data
+
+Opens the store, recomputes every total from players, promoters, live and
+archived tables, and prints each total that differs from the kept one. Then
+streams the ledger and checks that its entries balance and that every
+promoter's balance and unsettled entries match their pending payout.
+Exits 1 if anything differs. Stop the bot first.
+"""
+import argparse
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import main
+from bench import open_store
+from ledger import balances, promoter_account, unsettled
+from models import Totals
+from storage import Storage
+
+
+def flatten(totals: Totals) -> Dict[str, Any]:
+    values = totals.to_dict()
+    by_week = values.pop("house_cut_by_week")
+    values.update((f"house_cut:{week}", cut) for week, cut in by_week.items())
+    # money sums are floats; compare them to the cent
+    return {name: round(value, 2) for name, value in values.items() if value}
+
+
+def compare(kept: Totals, recomputed: Totals) -> List[Tuple[str, Any, Any]]:
+    kept_values, fresh = flatten(kept), flatten(recomputed)
+    return [
+        (name, kept_values.get(name, 0), fresh.get(name, 0))
+        for name in sorted(kept_values.keys() | fresh.keys())
+        if kept_values.get(name, 0) != fresh.get(name, 0)
+    ]
+
+
+def check_ledger(store: Storage) -> List[Tuple[str, Any, Any]]:
+    """(what, kept, from the ledger) for every promoter that disagrees."""
+    # two streaming passes; neither holds the whole ledger in memory
+    by_account = balances(store.iter_ledger())
+    open_entries = unsettled(store.iter_ledger())
+    differences = []
+    off = round(sum(by_account.values()), 2)
+    if off:
+        differences.append(("ledger sum", 0, off))
+    for promoter in store.iter_promoters():
+        account = promoter_account(promoter.id)
+        pending = round(promoter.pending_payout, 2)
+        balance = round(by_account.get(account, 0), 2)
+        if balance != pending:
+            differences.append((f"{account} balance", pending, balance))
+        due = round(sum(e.amount for e in open_entries.get(account, ())), 2)
+        if due != pending:
+            differences.append((f"{account} unsettled", pending, due))
+    return differences
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backend", choices=("json", "sqlite"),
+                        default=main.STORAGE_BACKEND,
+                        help="default: $STORAGE_BACKEND or json")
+    parser.add_argument("--data-dir", type=Path, default=main.DATA_DIR)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = open_store(args.backend, args.data_dir)
+    try:
+        differences = compare(store.totals(), store.recompute_totals())
+        differences += check_ledger(store)
+    finally:
+        store.close()
+    for name, kept, recomputed in differences:
+        print(f"{name}: kept {kept}, recomputed {recomputed}")
+    if differences:
+        sys.exit(1)
+    print("totals and ledger match")